@@ -2,8 +2,28 @@ import os
 import pandas as pd
 
 from src.process.train_process import process_train 
-from src.process.inference_process import inference, run_all
-from src.ocr.ocr_process import draw_boxes
+from src.process.inference_process import InferenceSession, run_all
+from src.ocr.blank_fields import BLANK_INK_THRESHOLD
+from src.ocr.ocr_cache import OCRCache, OCR_CACHE_PATH
+from src.process.progress import MAX_ATTEMPTS
+from src.ocr.ocr_trocr import TROCR_BATCH_SIZE
+from src.ocr.ocr_process import with_blank_confidence
+
+_session = None
+
+def get_session(path_models='./data/forms_ref', mosaic=False, trocr_backend='eager', blank_threshold=BLANK_INK_THRESHOLD, ocr_cache=OCR_CACHE_PATH,
+                trocr_batch_size=TROCR_BATCH_SIZE):
+    """Return the inference session shared by every call of this module."""
+    global _session
+    if _session is None or _session.path_models != path_models:
+        _session = InferenceSession(path_models)
+    _session.mosaic = mosaic
+    _session.trocr_backend = trocr_backend
+    _session.trocr_batch_size = trocr_batch_size
+    _session.blank_threshold = blank_threshold
+    if (_session.cache.path if _session.cache else None) != ocr_cache:
+        _session.cache = OCRCache(ocr_cache) if ocr_cache else None
+    return _session
 
 def save_result_csv(dataframe, file):
     
@@ -12,20 +32,31 @@ def save_result_csv(dataframe, file):
     else:
         path_csv = 'dataframe_all_result.csv'
 
-    dataframe.to_csv(path_csv, index=False)
+    # The confidence of the blank fields is kept in '<label>_blank_conf' columns.
+    with_blank_confidence(dataframe).to_csv(path_csv, index=False)
     print(f"Result in {path_csv} file.")
 
-def process_inference_file(path, nb_ocr, ocr):
-    match_form, _, image = inference(path, path_models='./data/forms_ref')
+def process_inference_file(path, nb_ocr, ocr, session=None, mosaic=False, trocr_backend='eager', blank_threshold=BLANK_INK_THRESHOLD, ocr_cache=OCR_CACHE_PATH,
+                           trocr_batch_size=TROCR_BATCH_SIZE):
+    if session is None:
+        session = get_session(mosaic=mosaic, trocr_backend=trocr_backend, blank_threshold=blank_threshold, ocr_cache=ocr_cache,
+                              trocr_batch_size=trocr_batch_size)
+
+    match_form, _, image = session.classify_and_align(path)
     print(f"Form: {match_form}")
-    img, strings, df = draw_boxes(ocr, image, match_form, nb_ocr)
+    img, strings, df = session.extract_fields(ocr, image, match_form, nb_ocr)
     save_result_csv(df, file=True)
 
     return df
 
 
-def process_inference_excel(path_excel, ocr, nb_files, nb_ocr):    
+def process_inference_excel(path_excel, ocr, nb_files, nb_ocr, session=None, workers=1, pipeline=False, mosaic=False, trocr_backend='eager', blank_threshold=BLANK_INK_THRESHOLD, ocr_cache=OCR_CACHE_PATH,
+                            resume=False, max_attempts=MAX_ATTEMPTS, trocr_batch_size=TROCR_BATCH_SIZE):
+    # With several workers, each worker process loads its own session.
+    if session is None and workers <= 1:
+        session = get_session(mosaic=mosaic, trocr_backend=trocr_backend, blank_threshold=blank_threshold, ocr_cache=ocr_cache,
+                              trocr_batch_size=trocr_batch_size)
 
-    df = run_all(path=path_excel, path_model='./data/forms_ref', ocr=ocr, nb_forms=nb_files, nb_ocr=nb_ocr)
+    df = run_all(path=path_excel, path_model='./data/forms_ref', ocr=ocr, nb_forms=nb_files, nb_ocr=nb_ocr, session=session, workers=workers, pipeline=pipeline, mosaic=mosaic, trocr_backend=trocr_backend, blank_threshold=blank_threshold, ocr_cache=ocr_cache, resume=resume, max_attempts=max_attempts, trocr_batch_size=trocr_batch_size)
     
     return df
\ No newline at end of file
@@ -1,6 +1,10 @@
 import argparse
 from src.process.train_process import process_train 
 from form_recognizer import process_inference_file, process_inference_excel
+from src.ocr.blank_fields import BLANK_INK_THRESHOLD
+from src.ocr.ocr_cache import OCR_CACHE_PATH
+from src.process.progress import MAX_ATTEMPTS
+from src.ocr.ocr_trocr import TROCR_BATCH_SIZE
 
 def execute_preprocess(path, force=False):
     print(f"Exécution de preprocess sur {path}")
@@ -8,7 +12,7 @@ def execute_preprocess(path, force=False):
         print("Option --force activée")
     process_train(path, force)
 
-def execute_inference_excel(path, nb_file, nb_ocr, ocr, benchmark=False):
+def execute_inference_excel(path, nb_file, nb_ocr, ocr, benchmark=False, workers=1, pipeline=False, mosaic=False, trocr_backend='eager', blank_threshold=BLANK_INK_THRESHOLD, ocr_cache=OCR_CACHE_PATH, resume=False, max_attempts=MAX_ATTEMPTS, trocr_batch_size=TROCR_BATCH_SIZE):
     if benchmark:
         print("Benchmark activé")
 
@@ -16,9 +20,9 @@ def execute_inference_excel(path, nb_file, nb_ocr, ocr, benchmark=False):
 
     assert ocr in ocrs, f"L'OCR spécifié '{ocr}' n'est pas dans la liste des OCRs autorisés: '{ocrs}'"
     print(f'OCR: {ocr}')
-    process_inference_excel(path, ocr, nb_files=nb_file, nb_ocr=nb_ocr)
+    process_inference_excel(path, ocr, nb_files=nb_file, nb_ocr=nb_ocr, workers=workers, pipeline=pipeline, mosaic=mosaic, trocr_backend=trocr_backend, blank_threshold=blank_threshold, ocr_cache=ocr_cache, resume=resume, max_attempts=max_attempts, trocr_batch_size=trocr_batch_size)
 
-def execute_inference_file(path, nb_ocr, ocr, benchmark=False):
+def execute_inference_file(path, nb_ocr, ocr, benchmark=False, mosaic=False, trocr_backend='eager', blank_threshold=BLANK_INK_THRESHOLD, ocr_cache=OCR_CACHE_PATH, trocr_batch_size=TROCR_BATCH_SIZE):
     print(f"Exécution de inference sur {path}")
     if benchmark:
         print("Benchmark activé")
@@ -26,7 +30,7 @@ def execute_inference_file(path, nb_ocr, ocr, benchmark=False):
     ocrs = ['google', 'trocr', 'tesseract']
     assert ocr in ocrs, f"L'OCR spécifié '{ocr}' n'est pas dans la liste des OCRs autorisés: '{ocrs}'"
     print(f'OCR: {ocr}')
-    process_inference_file(path=path, nb_ocr=nb_ocr, ocr=ocr)
+    process_inference_file(path=path, nb_ocr=nb_ocr, ocr=ocr, mosaic=mosaic, trocr_backend=trocr_backend, blank_threshold=blank_threshold, ocr_cache=ocr_cache, trocr_batch_size=trocr_batch_size)
 
 def parse_command_line():
     parser = argparse.ArgumentParser(description='Parser pour ligne de commande.')
@@ -40,6 +44,15 @@ def parse_command_line():
     parser.add_argument('-ocr', metavar='OCR', type=str, default='google', help='OCR à utiliser (google or trocr or tesseract)')
     parser.add_argument('-nb_files', metavar='NB_FILES', type=int, default=1, help='Nombre de formulaires à traiter (uniquement avec inference)')
     parser.add_argument('-nb_ocr', metavar='NB_OCR', type=int, default=5, help='Nombre d\'OCR à traiter (uniquement avec inference)')
+    parser.add_argument('-pipeline', action='store_true', help='Chevaucher lecture, alignement et OCR des formulaires (uniquement avec inference_excel)')
+    parser.add_argument('-workers', metavar='WORKERS', type=int, default=1, help='Nombre de processus pour traiter les formulaires (uniquement avec inference_excel)')
+    parser.add_argument('-trocr_backend', metavar='TROCR_BACKEND', type=str, default='eager', choices=['eager', 'int8', 'onnx'], help='Exécution de TrOCR (eager, int8 ou onnx)')
+    parser.add_argument('-trocr_batch_size', metavar='TROCR_BATCH_SIZE', type=int, default=TROCR_BATCH_SIZE, help='Nombre de champs traités ensemble par TrOCR')
+    parser.add_argument('-blank_threshold', metavar='BLANK_THRESHOLD', type=float, default=BLANK_INK_THRESHOLD, help='Part d\'encre nouvelle sous laquelle un champ est considéré vide et n\'est pas envoyé à l\'OCR (0 pour désactiver)')
+    parser.add_argument('-no_ocr_cache', action='store_true', help='Ne pas réutiliser les textes déjà reconnus (cache dans data/ocr_cache.sqlite)')
+    parser.add_argument('-resume', action='store_true', help='Reprendre le traitement précédent : les SPI déjà traités sont ignorés, ceux en échec sont retentés (uniquement avec inference_excel)')
+    parser.add_argument('-max_attempts', metavar='MAX_ATTEMPTS', type=int, default=MAX_ATTEMPTS, help='Nombre de tentatives par SPI avant de l\'abandonner avec -resume')
+    parser.add_argument('-mosaic', action='store_true', help='Regrouper les champs d\'une page en quelques images pour l\'OCR Google')
 
     parser.add_argument('-benchmark', action='store_true', help='Activer le benchmark (uniquement avec inference)')
     args = parser.parse_args()
@@ -60,10 +73,12 @@ def main():
         execute_preprocess(args.preprocess, args.force)
 
     if args.inference_file:
-        execute_inference_file(args.inference_file, args.nb_ocr, args.ocr, args.benchmark)
+        execute_inference_file(args.inference_file, args.nb_ocr, args.ocr, args.benchmark, args.mosaic, args.trocr_backend, args.blank_threshold, None if args.no_ocr_cache else OCR_CACHE_PATH,
+                               args.trocr_batch_size)
 
     if args.inference_excel:
-        execute_inference_excel(args.inference_excel ,args.nb_files, args.nb_ocr, args.ocr, args.benchmark)
+        execute_inference_excel(args.inference_excel ,args.nb_files, args.nb_ocr, args.ocr, args.benchmark, args.workers, args.pipeline, args.mosaic, args.trocr_backend, args.blank_threshold, None if args.no_ocr_cache else OCR_CACHE_PATH,
+                                args.resume, args.max_attempts, args.trocr_batch_size)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,9 +1,30 @@
+import os
+import sys
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
 import Levenshtein as lev
+from src.process.manifest import read_ods_sheets, read_xlsx_sheets, as_text, parquet_cache
+
+try:
+    # Similarity of whole columns in one call (rapidfuzz >= 3.6), same scores as lev.ratio.
+    from rapidfuzz.process import cpdist
+    from rapidfuzz.distance import Indel
+except ImportError:
+    cpdist = None
 
 #verite_terrain_path = 'verite_terrain.ods'
 #acquisition_google_path = "04122023_1451.ods"
 
+# Sheets with more compared cells than this are split by columns between processes.
+COMPARE_PARALLEL_MIN_CELLS = 500000
+
+BENCH_SHEETS = ['2042K', '2042KAUTO', '2042']
+# Parquet conversions of the ground truth, one file per sheet, named after the mtime of the workbook.
+GROUND_TRUTH_CACHE_PATH = './data/benchmark_cache'
+
 # Function to generate column names like Excel (A, B, ..., Z, AA, AB, ...)
 def generate_excel_column_names(n):
     names = []
@@ -12,21 +33,49 @@ def generate_excel_column_names(n):
         names.append(chr(65 + remainder))
     return ''.join(reversed(names))
 
-def read_sheet(file, sheet_name):
-    # Read the sheet with no header to get the label row separately
-    df = pd.read_excel(file, sheet_name=sheet_name, header=None)
-    
+def label_sheet(df):
+    """Name the columns of a sheet read without header after the label row, keep the data rows."""
     # Separate label row and data
     label_row = df.iloc[1]  # Second row as labels
     data = df.iloc[2:]  # Data starting from the third row
 
     # Generate column names and concatenate with label names
-    column_names = [generate_excel_column_names(i + 1) + ' (' + str(label) + ')' 
+    column_names = [generate_excel_column_names(i + 1) + ' (' + ('nan' if pd.isna(label) else str(label)) + ')' 
                     for i, label in enumerate(label_row)]
 
     data.columns = column_names
     return data
 
+def read_sheets(file, sheet_names=BENCH_SHEETS):
+    """
+    Read several sheets of an ODS or XLSX workbook in one pass.
+
+    :return: dict sheet name -> DataFrame, as read_sheet
+    """
+    if file.endswith('.ods'):
+        sheets = read_ods_sheets(file, sheet_names, header=None)
+    else:
+        # Formulas are read as computed by the application that last saved the workbook. The OCR texts
+        # starting with '=' that openpyxl saved as formulas have no computed value, they are read as written.
+        sheets = read_xlsx_sheets(file, sheet_names, header=None, formulas=True)
+        # Lines of a cell are joined without separator, as when the workbook went through an ODS conversion.
+        sheets = {sheet_name: df.map(lambda value: value.replace('\n', '') if isinstance(value, str) else value)
+                  for sheet_name, df in sheets.items()}
+    return {sheet_name: label_sheet(sheets[sheet_name]) for sheet_name in sheet_names}
+
+def read_sheet(file, sheet_name):
+    return read_sheets(file, [sheet_name])[sheet_name]
+
+def load_ground_truth(file, sheet_names=BENCH_SHEETS, cache_path=GROUND_TRUTH_CACHE_PATH):
+    """
+    Sheets of the ground truth as text, kept in parquet files converted again when
+    the workbook changes (see parquet_cache).
+
+    :return: dict sheet name -> DataFrame
+    """
+    paths = parquet_cache(file, cache_path, sheet_names, lambda file: read_sheets(file, sheet_names))
+    return {sheet_name: pd.read_parquet(path) for sheet_name, path in paths.items()}
+
 # # Read each sheet into a DataFrame
 # df_2042K = read_sheet(verite_terrain_path, '2042K')
 # df_2042KAUTO = read_sheet(verite_terrain_path, '2042KAUTO')
@@ -81,31 +130,104 @@ def compare_values(ground_truth, acquisition):
     return 'No Match'
 
 
-def compare_sheets(df_truth, df_google, id_col):
-    comparison_rows = []
-    for index, google_row in df_google.iterrows():
-        identifier = google_row[id_col]
-        match = df_truth[df_truth[id_col] == identifier]
-        if not match.empty:
-            ground_truth_row = match.iloc[0]
-            comparison_row = {col: compare_values(google_row[col], ground_truth_row[col])
-                              for col in df_google.columns}
-        else:
-            comparison_row = {col: '#' for col in df_google.columns}
-        comparison_rows.append(comparison_row)
-    return pd.DataFrame(comparison_rows)
+@functools.lru_cache(maxsize=None)
+def _normalize_table():
+    # Characters removed by normalize_string: combining marks (accents once decomposed), ' ', '/' and '-'.
+    table = {code: None for code in range(sys.maxunicode + 1) if unicodedata.category(chr(code)) == 'Mn'}
+    table.update({ord(' '): None, ord('/'): None, ord('-'): None})
+    return table
+
+def normalize_column(values):
+    """normalize_string on a whole array of values at once."""
+    shape = np.shape(values)
+    values = pd.Series(np.ravel(values), dtype=object)
+    values = values.where(values.notna(), '').astype(str)
+    normalized = values.str.normalize('NFD').str.translate(_normalize_table()).str.lower()
+    return normalized.to_numpy(dtype=object).reshape(shape)
+
+def similarities(left, right):
+    """lev.ratio of each pair of strings."""
+    if cpdist is not None:
+        return cpdist(list(left), list(right), scorer=Indel.normalized_similarity)
+    return np.array([lev.ratio(a, b) for a, b in zip(left, right)])
+
+def compare_columns(ground_truth, acquisition):
+    """
+    compare_values on two arrays of the same shape (columns, or blocks of columns).
+
+    :return: numpy array of the labels, of the same shape
+    """
+    shape = np.shape(ground_truth)
+    ground_truth = normalize_column(ground_truth).ravel()
+    acquisition = normalize_column(acquisition).ravel()
+
+    ground_truth_empty = ground_truth == ''
+    acquisition_empty = acquisition == ''
+    equal = ground_truth == acquisition
+
+    # Levenshtein and containment only for the pairs that are neither empty nor equal.
+    candidates = np.flatnonzero(~ground_truth_empty & ~acquisition_empty & ~equal)
+    almost = np.zeros(len(ground_truth), dtype=bool)
+    almost[candidates] = similarities(ground_truth[candidates], acquisition[candidates]) >= 0.7
+    contains = np.zeros(len(ground_truth), dtype=bool)
+    contains[candidates] = [len(a) >= 5 and a in g for g, a in zip(ground_truth[candidates], acquisition[candidates])]
+
+    # From the lowest to the highest priority of compare_values.
+    labels = np.full(len(ground_truth), 'No Match', dtype=object)
+    labels[contains] = 'Contains Match'
+    labels[almost] = 'Almost Match'
+    labels[equal] = 'Full Match'
+    labels[ground_truth_empty & ~acquisition_empty] = 'Empty No Match'
+    labels[ground_truth_empty & acquisition_empty] = 'Empty Match'
+    return labels.reshape(shape)
+
+def _compare_block(task):
+    return compare_columns(*task)
+
+def compare_sheets(df_truth, df_google, id_col, workers=None):
+    """
+    Compare each acquisition row with the first ground truth row of the same id, column
+    by column (compare_values, the acquisition value being its first argument). Rows
+    whose id is not in the ground truth are '#' everywhere.
+
+    :param workers: processes sharing the columns, by default one per core for the
+        sheets of more than COMPARE_PARALLEL_MIN_CELLS cells, 1 otherwise.
+    """
+    if df_google.empty:
+        return pd.DataFrame()
+
+    # Hash join on the id: position of the first ground truth row of each acquisition id.
+    truth_ids = df_truth[id_col].reset_index(drop=True).dropna().drop_duplicates(keep='first')
+    rows = pd.Index(truth_ids).get_indexer(df_google[id_col])
+    rows[df_google[id_col].isna().to_numpy()] = -1
+    matched = rows >= 0
+    truth_rows = truth_ids.index.to_numpy()[rows[matched]]
+
+    acquisition = df_google.to_numpy(dtype=object)[matched]
+    ground_truth = df_truth[df_google.columns].to_numpy(dtype=object)[truth_rows]
+
+    if workers is None:
+        workers = (os.cpu_count() or 1) if acquisition.size > COMPARE_PARALLEL_MIN_CELLS else 1
+    if workers > 1:
+        blocks = [block for block in np.array_split(np.arange(acquisition.shape[1]), workers) if len(block)]
+        with ProcessPoolExecutor(max_workers=len(blocks), mp_context=multiprocessing.get_context('spawn')) as executor:
+            labels = np.hstack(list(executor.map(_compare_block, [(acquisition[:, block], ground_truth[:, block]) for block in blocks])))
+    else:
+        labels = compare_columns(acquisition, ground_truth)
+
+    comparison = np.full(df_google.shape, '#', dtype=object)
+    comparison[matched] = labels
+    return pd.DataFrame(comparison, columns=df_google.columns)
 
 def export_to_csv(df, filename):
     df.to_csv(filename, index=False)
 
 def run_bench(verite_terrain_path, acquisition_google_path):
-    # Reading sheets into DataFrames
-    df_2042K = read_sheet(verite_terrain_path, '2042K')
-    df_2042KAUTO = read_sheet(verite_terrain_path, '2042KAUTO')
-    df_2042 = read_sheet(verite_terrain_path, '2042')
-    df_2042K_google = read_sheet(acquisition_google_path, '2042K')
-    df_2042KAUTO_google = read_sheet(acquisition_google_path, '2042KAUTO')
-    df_2042_google = read_sheet(acquisition_google_path, '2042')
+    # Reading sheets into DataFrames, each workbook in one pass (ODS or XLSX)
+    truth = load_ground_truth(verite_terrain_path)
+    acquisition = {sheet_name: as_text(df) for sheet_name, df in read_sheets(acquisition_google_path).items()}
+    df_2042K, df_2042KAUTO, df_2042 = truth['2042K'], truth['2042KAUTO'], truth['2042']
+    df_2042K_google, df_2042KAUTO_google, df_2042_google = acquisition['2042K'], acquisition['2042KAUTO'], acquisition['2042']
 
     # Comparing sheets and generating results
     df_2042K_google_results = compare_sheets(df_2042K, df_2042K_google, 'C (SPI 1)')
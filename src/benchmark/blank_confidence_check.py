@@ -0,0 +1,65 @@
+import json
+import os
+import pickle
+import sys
+import tempfile
+
+import pandas as pd
+from PIL import Image
+
+from src.ocr.ocr_process import page_dataframe, concat_pages, with_blank_confidence
+from src.process.progress import ProgressJournal
+
+def synthetic_page(labels, blank_labels):
+    """Arguments of page_dataframe for a page whose blank_labels were skipped, the other fields read as their label."""
+    fields = [(label, Image.new('L', (40, 20), 255)) for label in labels]
+    values = {label: "" for label in blank_labels}
+    confidences = {label: 0.5 + i / 10 for i, label in enumerate(blank_labels)}
+    text_fields = [field for field in fields if field[0] not in values]
+    return fields, values, confidences, text_fields, [label for label, _ in text_fields]
+
+def check_blank_confidence():
+    """
+    Check that the confidence of the blank fields of a form, recto and verso, reaches
+    the outputs: the '<label>_blank_conf' columns of the CSV of save_result_csv and
+    the 'done' entry of the progress journal.
+
+    :return: bool
+    """
+    recto = synthetic_page(['A', 'B', 'C'], ['B'])
+    verso = synthetic_page(['D', 'E'], ['D', 'E'])
+    expected = {**recto[2], **verso[2]}
+    df = concat_pages([page_dataframe(*recto), page_dataframe(*verso)])
+    # Rows of run_all -workers come back pickled from the worker processes.
+    df = pickle.loads(pickle.dumps(df))
+    ok = True
+
+    with tempfile.TemporaryDirectory() as directory:
+        csv_path = os.path.join(directory, 'result.csv')
+        with_blank_confidence(df).to_csv(csv_path, index=False)
+        row = pd.read_csv(csv_path).iloc[0]
+        csv_confidences = {column[:-len('_blank_conf')]: row[column] for column in row.index if column.endswith('_blank_conf')}
+        if csv_confidences != expected:
+            print(f"CSV: blank confidences {csv_confidences}, expected {expected}")
+            ok = False
+
+        progress_path = os.path.join(directory, 'progress.jsonl')
+        with ProgressJournal(progress_path) as progress:
+            progress.done(0, 0., os.path.join(directory, 'result.xlsx'), '2042', df.attrs.get('blank_confidence'))
+        with open(progress_path, 'r') as journal:
+            entry = json.loads(journal.readline())
+        if entry.get('blank_confidence') != expected:
+            print(f"Progress journal: blank confidences {entry.get('blank_confidence')}, expected {expected}")
+            ok = False
+
+    print(f"==> {len(expected)} blank fields, confidences kept in the CSV and the progress journal: {ok}")
+    return ok
+
+def main():
+    # python -m src.benchmark.blank_confidence_check
+    if not check_blank_confidence():
+        print("Error: the confidence of the blank fields is lost before the outputs.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import glob
+import os
+import sys
+
+import cv2
+import numpy as np
+
+from src.ocr.blank_fields import BLANK_INK_THRESHOLD, TEMPLATE_TOLERANCE
+from src.ocr.field_templates import load_field_template
+from src.ocr.ocr_process import prepare_fields, template_types
+from src.process.alignment import AlignedPage
+from src.process.process import load_page
+
+# Smallest pen stroke, in pixels at the alignment resolution, that makes a field written.
+MIN_STROKE_PIXELS = 40
+# Pale printed rules moved by the alignment are 1 or 2 pixels high, a written character is taller.
+MIN_STROKE_HEIGHT = 5
+
+def align_sift(page, reference, nb_features=4000, ratio=0.7):
+    """
+    Homography from a page to its reference form with SIFT, so that the check runs without
+    the SuperPoint weights. Same matching as find_best_match: ratio test, then RANSAC.
+    """
+    sift = cv2.SIFT_create(nb_features)
+    keypoints, descriptors = sift.detectAndCompute(page, None)
+    ref_keypoints, ref_descriptors = sift.detectAndCompute(reference, None)
+    matches = [m for m, n in cv2.BFMatcher().knnMatch(descriptors, ref_descriptors, k=2) if m.distance < ratio * n.distance]
+    src_pts = np.float32([keypoints[m.queryIdx].pt for m in matches])
+    dst_pts = np.float32([ref_keypoints[m.trainIdx].pt for m in matches])
+    H, _ = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
+    return H
+
+def written_strokes(aligned, reference, min_stroke=MIN_STROKE_PIXELS):
+    """
+    Pixels of the strokes written on an aligned page, found independently of field_ink:
+    dark for the Otsu threshold of the whole page, not printed on the reference (Otsu
+    threshold of the reference, widened by TEMPLATE_TOLERANCE) and in a connected
+    component of at least min_stroke pixels and MIN_STROKE_HEIGHT pixels high.
+
+    :return: HxW bool array in reference coordinates.
+    """
+    warped = cv2.warpPerspective(aligned.page, aligned.H, aligned.size)
+    # Only the pixels of the scan, not the black borders added by the warp.
+    inside = cv2.erode(cv2.warpPerspective(np.full_like(aligned.page, 255), aligned.H, aligned.size), np.ones((7, 7), np.uint8)) > 0
+    page_threshold, _ = cv2.threshold(warped, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    reference_threshold, _ = cv2.threshold(reference, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    size = 2 * TEMPLATE_TOLERANCE + 1
+    printed = cv2.dilate(np.uint8(reference < reference_threshold), np.ones((size, size), np.uint8)) > 0
+
+    ink = (warped < page_threshold) & inside & ~printed
+    nb_components, components, stats, _ = cv2.connectedComponentsWithStats(np.uint8(ink))
+    strokes = (stats[:, cv2.CC_STAT_AREA] >= min_stroke) & (stats[:, cv2.CC_STAT_HEIGHT] >= MIN_STROKE_HEIGHT)
+    strokes[0] = False
+    return strokes[components]
+
+def check_page(image_path, match_form, path_models, blank_threshold, min_stroke=MIN_STROKE_PIXELS):
+    """
+    Align a page on its reference form and split its fields as prepare_fields does.
+
+    :return: (number of text fields, list of the labels skipped as blank, list of the labels
+        written according to written_strokes but skipped)
+    """
+    reference = load_page(os.path.join(path_models, match_form, f"{match_form}.jpg"))
+    page = load_page(image_path)
+    H = np.eye(3) if os.path.basename(image_path) == f"{match_form}.jpg" else align_sift(page, reference)
+    aligned = AlignedPage(page, H, image_path)
+
+    template = load_field_template(match_form)
+    types = template_types(template)
+    _, values, _, _ = prepare_fields(aligned, match_form, len(template), blank_threshold=blank_threshold, path_models=path_models, template=template)
+    skipped = [label for label in values if types[label] != 'checkbox']
+
+    strokes = written_strokes(aligned, reference, min_stroke)
+    missed = []
+    for field in template[np.isin(template['label'], skipped)]:
+        left, upper, right, lower = [int(round(field[key])) for key in ('x0', 'y0', 'x1', 'y1')]
+        if np.count_nonzero(strokes[upper:lower, left:right]) >= min_stroke:
+            missed.append(str(field['label']))
+    return sum(kind != 'checkbox' for kind in types.values()), skipped, missed
+
+def run_blank_fields_check(path_models, blank_threshold=BLANK_INK_THRESHOLD, nb_pages=None):
+    """
+    Run the blank field detection on the filled samples of the reference forms: no written
+    field may be skipped, and every text field of a reference form aligned on itself must be.
+
+    :param nb_pages: filled samples checked per form, all if None.
+    :return: bool
+        True if the checks pass on every page, False if one fails or there is no page.
+    """
+    ok = True
+    nb_checked = total_fields = total_skipped = 0
+    for match_form in sorted(os.listdir(path_models)):
+        reference_path = os.path.join(path_models, match_form, f"{match_form}.jpg")
+        if not os.path.isfile(reference_path):
+            continue
+        samples = sorted(path for path in glob.glob(os.path.join(path_models, match_form, '*.jpg')) if path != reference_path)
+
+        nb_fields, skipped, _ = check_page(reference_path, match_form, path_models, blank_threshold)
+        if len(skipped) != nb_fields:
+            print(f"{reference_path}: {nb_fields - len(skipped)} fields of the blank form sent to the OCR")
+            ok = False
+
+        for image_path in samples[:nb_pages]:
+            nb_fields, skipped, missed = check_page(image_path, match_form, path_models, blank_threshold)
+            print(f"{image_path}: {len(skipped)}/{nb_fields} text fields skipped, written but skipped: {missed or 'none'}")
+            ok = ok and not missed
+            nb_checked += 1
+            total_fields += nb_fields
+            total_skipped += len(skipped)
+
+    if not nb_checked:
+        # Nothing compared is not a passed check.
+        print(f"No filled sample found in {path_models}.")
+        return False
+    print(f"==> {nb_checked} pages, {total_skipped}/{total_fields} text fields skipped as blank. No written field skipped: {ok}")
+    return ok
+
+def main():
+    # python -m src.benchmark.blank_fields_check (pages alignées avec SIFT, sans les poids SuperPoint)
+    parser = argparse.ArgumentParser(description='Check of the blank field detection on real aligned pages.')
+    parser.add_argument('-path_models', metavar='PATH_MODELS', type=str, default='./data/forms_ref', help='Dossier des formulaires de référence et de leurs exemples remplis')
+    parser.add_argument('-blank_threshold', metavar='BLANK_THRESHOLD', type=float, default=BLANK_INK_THRESHOLD, help='Seuil d\'encre sous lequel un champ est laissé vide')
+    parser.add_argument('-nb_pages', metavar='NB_PAGES', type=int, default=None, help='Nombre d\'exemples vérifiés par formulaire (tous par défaut)')
+    args = parser.parse_args()
+
+    if not run_blank_fields_check(args.path_models, args.blank_threshold, args.nb_pages):
+        print("Error: written fields are skipped as blank, or no page was checked.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+import math
+import os
+import sys
+import tempfile
+from io import BytesIO
+
+from PIL import Image
+from google.cloud.vision_v1 import types
+from google.rpc import status_pb2
+
+from src.ocr.fake_vision import FakeVisionServer, image_size_text
+from src.ocr.ocr_cache import OCRCache
+from src.ocr.ocr_google import MAX_IMAGES_PER_REQUEST, build_mosaics
+from src.ocr.ocr_process import recognize_fields
+
+def synthetic_fields(nb_fields, min_width=40):
+    """(label, crop) of white crops of distinct sizes, so that the fake server tells them apart."""
+    return [(f"F{i}", Image.new('L', (min_width + 3 * i, 20 + i % 7), 255)) for i in range(nb_fields)]
+
+def check_batching(nb_fields=40):
+    """The crops are sent MAX_IMAGES_PER_REQUEST per request and each text goes back to its field."""
+    fields = synthetic_fields(nb_fields)
+    with FakeVisionServer() as server:
+        texts = recognize_fields('google', fields)
+    expected = [f"{cropped.width}x{cropped.height}" for _, cropped in fields]
+    ok = texts == expected and server.nb_images == nb_fields and server.nb_requests == math.ceil(nb_fields / MAX_IMAGES_PER_REQUEST)
+    print(f"Batching: {nb_fields} fields in {server.nb_requests} requests, texts in order: {texts == expected} -> {ok}")
+    return ok
+
+def word(description, left, upper, right, lower):
+    vertices = [types.Vertex(x=x, y=y) for x, y in ((left, upper), (right, upper), (right, lower), (left, lower))]
+    return types.EntityAnnotation(description=description, bounding_poly=types.BoundingPoly(vertices=vertices))
+
+def check_mosaic(nb_fields=200):
+    """With mosaic, the crops go in a few images and the words found in a tile go back to its field."""
+    # Wide enough crops to fill several mosaics.
+    fields = synthetic_fields(nb_fields, min_width=300)
+    mosaics = build_mosaics([cropped for _, cropped in fields])
+    # The server writes a word in the middle of each tile, as Vision would read the field.
+    layouts = {mosaic.size: tiles for mosaic, tiles in mosaics}
+
+    def text_for_image(content):
+        tiles = layouts[Image.open(BytesIO(content)).size]
+        words = [word(f"w{i}", left + 2, upper + 2, right - 2, lower - 2) for i, left, upper, right, lower in tiles.tolist()]
+        return [types.EntityAnnotation(description=' '.join(w.description for w in words))] + words
+
+    with FakeVisionServer(text_for_image) as server:
+        texts = recognize_fields('google', fields, mosaic=True)
+    expected = [f"w{i}" for i in range(nb_fields)]
+    ok = texts == expected and server.nb_images == len(mosaics) > 1
+    print(f"Mosaic: {nb_fields} fields in {server.nb_images} images, words given back to their field: {texts == expected} -> {ok}")
+    return ok
+
+def check_errors_not_cached(nb_fields=20, failing_every=4):
+    """The fields Vision failed on are written "" and not cached: the next run sends only them."""
+    fields = synthetic_fields(nb_fields)
+    failing = {f"{cropped.width}x{cropped.height}" for i, (_, cropped) in enumerate(fields) if i % failing_every == 0}
+
+    def text_for_image(content):
+        text = image_size_text(content)
+        return status_pb2.Status(code=8, message='Quota exceeded') if text in failing else text
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = OCRCache(os.path.join(directory, 'ocr_cache.sqlite'))
+        with FakeVisionServer(text_for_image):
+            first = recognize_fields('google', fields, cache=cache)
+        with FakeVisionServer() as server:
+            second = recognize_fields('google', fields, cache=cache)
+        cache.close()
+
+    expected = [f"{cropped.width}x{cropped.height}" for _, cropped in fields]
+    first_ok = first == ["" if text in failing else text for text in expected]
+    ok = first_ok and second == expected and server.nb_images == len(failing)
+    print(f"Errors: {len(failing)}/{nb_fields} failed fields written empty: {first_ok}, "
+          f"sent again at the next run: {server.nb_images} -> {ok}")
+    return ok
+
+def main():
+    # python -m src.benchmark.google_ocr_check (serveur Vision local, sans identifiants ni réseau)
+    results = [check_batching(), check_mosaic(), check_errors_not_cached()]
+    if not all(results):
+        print("Error: the Google OCR path does not give the expected texts.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from src.superpoint.superpoint import SuperPointFrontend
+from src.process.process import load_page, superpoint_input
+
+NMS_MODES = ['fast', 'maxpool']
+
+def corners_agreement(pts_a, pts_b):
+    """Ratio of corners shared by two 3xN corner arrays (1.0 when identical)."""
+    corners_a = set(map(tuple, pts_a[:2].T.astype(int)))
+    corners_b = set(map(tuple, pts_b[:2].T.astype(int)))
+    if not corners_a and not corners_b:
+        return 1.
+    return len(corners_a & corners_b) / len(corners_a | corners_b)
+
+def synthetic_heatmap(rng, H, W, nb_blobs, sigma=1.5):
+    """HxW float32 heatmap in [0,1]: blurred peaks of random height on low noise, like a SuperPoint output."""
+    peaks = np.zeros((H, W), np.float32)
+    peaks[rng.integers(0, H, nb_blobs), rng.integers(0, W, nb_blobs)] = rng.uniform(0.1, 1, nb_blobs)
+    heatmap = cv2.GaussianBlur(peaks, (0, 0), sigma)
+    # The noise stays under conf_thresh, it only breaks the ties between neighbours
+    # (equal confidences are the one case where the two modes may differ).
+    heatmap = 0.99 * heatmap / heatmap.max() + rng.uniform(0, 0.01, (H, W))
+    return np.float32(heatmap)
+
+def check_synthetic(nb_heatmaps=50, size=(240, 320), conf_thresh=0.015, nms_dist=4, seed=0):
+    """
+    Compare nms_fast and nms_maxpool on random heatmaps, without the SuperPoint weights.
+
+    :return: bool
+        True if the two modes keep exactly the same corners on every heatmap.
+    """
+    rng = np.random.default_rng(seed)
+    H, W = size
+    parity = True
+    totals = {nms_mode: 0. for nms_mode in NMS_MODES}
+
+    for i in range(nb_heatmaps):
+        heatmap = synthetic_heatmap(rng, H, W, nb_blobs=int(rng.integers(10, H * W // 100)))
+        # Same input as postprocess: candidate corners above the threshold, then NMS.
+        start_time = time.perf_counter()
+        ys, xs = np.where(heatmap >= conf_thresh)
+        pts_fast, _ = SuperPointFrontend.nms_fast(np.vstack((xs, ys, heatmap[ys, xs])), H, W, nms_dist)
+        totals['fast'] += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        pts_maxpool = SuperPointFrontend.nms_maxpool(heatmap, conf_thresh, nms_dist)
+        totals['maxpool'] += time.perf_counter() - start_time
+
+        agreement = corners_agreement(pts_fast, pts_maxpool)
+        if agreement < 1.:
+            print(f"Synthetic heatmap {i}: agreement {agreement:.4f} ({pts_fast.shape[1]} / {pts_maxpool.shape[1]} corners)")
+            parity = False
+
+    print(f"==> {nb_heatmaps} synthetic {H}x{W} heatmaps, same corners: {parity}. Mean NMS time: "
+          + ", ".join(f"{nms_mode}: {totals[nms_mode] / nb_heatmaps * 1000:.1f}ms" for nms_mode in NMS_MODES))
+    return parity
+
+def time_postprocess(superpoint, semi, coarse_desc, H, W, nms_mode, repeat):
+    superpoint.nms_mode = nms_mode
+    timings = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        pts, desc, _ = superpoint.postprocess(semi, coarse_desc, H, W)
+        timings.append(time.perf_counter() - start_time)
+    return pts, desc, min(timings)
+
+def run_nms_benchmark(images_path, weights_path, repeat=3, min_agreement=0.999):
+    """
+    Compare the NMS modes of SuperPointFrontend on real pages: check that they
+    keep the same corners and report the post-processing time of each mode.
+
+    :return: bool
+        True if, on every page, at least min_agreement of the corners are
+        shared by the two modes, False if there is no page to compare.
+    """
+    superpoint = SuperPointFrontend(weights_path=weights_path, nms_dist=4, conf_thresh=0.015, nn_thresh=0.7)
+    image_paths = sorted(glob.glob(os.path.join(images_path, '**', '*.jpg'), recursive=True))
+    totals = {nms_mode: 0. for nms_mode in NMS_MODES}
+    parity = True
+
+    for image_path in image_paths:
+        image = superpoint_input(load_page(image_path))
+        H, W = image.shape
+        with torch.no_grad():
+            semi, coarse_desc = superpoint.net.forward(torch.from_numpy(image).view(1, 1, H, W))
+        semi = semi.data.cpu().numpy().squeeze()
+
+        results, timings = {}, {}
+        for nms_mode in NMS_MODES:
+            pts, desc, elapsed = time_postprocess(superpoint, semi, coarse_desc, H, W, nms_mode, repeat)
+            results[nms_mode] = pts
+            timings[nms_mode] = elapsed
+            totals[nms_mode] += elapsed
+
+        # Only corners with exactly equal confidences may be resolved differently.
+        agreement = corners_agreement(results['fast'], results['maxpool'])
+        parity = parity and agreement >= min_agreement
+        print(f"{image_path}: {results['fast'].shape[1]} corners | "
+              + " | ".join(f"{nms_mode}: {timings[nms_mode]:.3f}s" for nms_mode in NMS_MODES)
+              + f" | agreement: {agreement:.4f}")
+
+    if not image_paths:
+        # Nothing compared is not a passed check.
+        print(f"No .jpg page found in {images_path}.")
+        return False
+    print(f"==> {len(image_paths)} pages. Mean post-processing time: "
+          + ", ".join(f"{nms_mode}: {totals[nms_mode] / len(image_paths):.3f}s" for nms_mode in NMS_MODES))
+    return parity
+
+def main():
+    # python -m src.benchmark.nms_benchmark -images data/test
+    # python -m src.benchmark.nms_benchmark -synthetic (sans les poids SuperPoint)
+    parser = argparse.ArgumentParser(description='Parity check and micro-benchmark of the SuperPoint NMS modes.')
+    parser.add_argument('-images', metavar='IMAGES_PATH', type=str, default='data/test', help='Dossier des images à traiter')
+    parser.add_argument('-weights', metavar='WEIGHTS_PATH', type=str, default='src/superpoint/superpoint_v1.pth', help='Poids du modèle SuperPoint')
+    parser.add_argument('-repeat', metavar='REPEAT', type=int, default=3, help='Nombre de répétitions par image')
+    parser.add_argument('-min_agreement', metavar='MIN_AGREEMENT', type=float, default=0.999, help='Part minimale de coins communs aux deux modes')
+    parser.add_argument('-synthetic', action='store_true', help='Comparer les deux modes sur des cartes de chaleur synthétiques uniquement (sans poids ni images)')
+    args = parser.parse_args()
+
+    if not check_synthetic():
+        print("Error: the NMS modes do not keep the same corners on the synthetic heatmaps.")
+        sys.exit(1)
+    if args.synthetic:
+        return
+
+    if not run_nms_benchmark(args.images, args.weights, args.repeat, args.min_agreement):
+        print("Error: the NMS modes do not keep the same corners, or no page was compared.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import argparse
+import contextlib
+import io
+import re
+import time
+
+import Levenshtein as lev
+import torch
+
+from src.benchmark.benchmarking import load_ground_truth, normalize_string
+from src.process.inference_process import InferenceSession
+from src.process.process import get_page_paths, choose_good_excel
+from src.process.manifest import read_manifest
+from src.ocr.ocr_process import crop_fields
+from src.ocr.field_templates import load_field_template
+from src.ocr.ocr_trocr import TROCR_MODEL_NAME, TROCR_BACKENDS, load_trocr_model, extract_texts_from_images
+
+# Ground truth column holding the SPI of each sheet, as in run_bench.
+SPI_COLUMNS = {'2042': 'D (N° SPI 1)', '2042K': 'C (SPI 1)', '2042KAUTO': 'C (SPI 1)'}
+
+def digits(value):
+    return re.sub(r'\D', '', str(value))
+
+def collect_fields(manifest_path, verite_terrain_path, path_models, nb_files, nb_ocr):
+    """
+    Align the first nb_files SPIs of the manifest and crop their fields.
+
+    :return: list
+        (cropped PIL image, ground truth text) of every text field with a non empty ground truth.
+    """
+    manifest = read_manifest(manifest_path, columns=['Lot', 'Image', 'SPI'])
+    truths = load_ground_truth(verite_terrain_path, list(SPI_COLUMNS))
+    session = InferenceSession(path_models)
+
+    fields = []
+    for _, row in manifest.head(nb_files).iterrows():
+        path_recto = f"{row['Lot']}/{row['Image']}"
+        with contextlib.redirect_stdout(io.StringIO()):
+            pages = session.classify_and_align_batch(get_page_paths(path_recto))
+
+        sheet = choose_good_excel(pages[0][0])
+        truth = truths[sheet]
+        truth_rows = truth[truth[SPI_COLUMNS[sheet]].map(digits) == digits(row['SPI'])]
+        if truth_rows.empty:
+            print(f"SPI {row['SPI']}: not in the ground truth, skipped.")
+            continue
+
+        # Column letter -> ground truth value.
+        truth_row = {column.split(' ')[0]: value for column, value in truth_rows.iloc[0].items()}
+        for match_form, _, image in pages:
+            template = load_field_template(match_form)
+            # The CER is measured on the text fields only, not on the checkboxes ("X"), amounts and digits.
+            text_labels = set(template['label'][template['type'] == 'text'].tolist())
+            for label, cropped in crop_fields(image, template, nb_ocr):
+                text = normalize_string(truth_row.get(label))
+                if text and label in text_labels:
+                    fields.append((cropped, text))
+    return fields
+
+def character_error_rate(predictions, truths):
+    """Sum of the edit distances over the number of ground truth characters, after normalize_string."""
+    errors = sum(lev.distance(normalize_string(prediction), truth) for prediction, truth in zip(predictions, truths))
+    return errors / max(sum(len(truth) for truth in truths), 1)
+
+def run_trocr_benchmark(fields, backends, batch_size=16, nb_threads=None):
+    """
+    Run every TrOCR backend on the same crops.
+
+    :return: dict
+        backend -> {'latency': seconds per crop, 'cer': character error rate}, without
+        the backends whose dependencies are not installed.
+    """
+    if nb_threads:
+        torch.set_num_threads(nb_threads)
+    crops = [cropped for cropped, _ in fields]
+    truths = [truth for _, truth in fields]
+
+    results = {}
+    for backend in backends:
+        try:
+            model, processor = load_trocr_model(TROCR_MODEL_NAME, backend)
+        except ImportError as error:
+            # The onnx backend needs packages that requirements.txt does not pin, the other backends still run.
+            print(f"{backend}: skipped ({error})")
+            continue
+        # Warm up (first allocation, ONNX Runtime session).
+        extract_texts_from_images(crops[:batch_size], model, processor, batch_size)
+
+        start_time = time.perf_counter()
+        predictions = extract_texts_from_images(crops, model, processor, batch_size)
+        elapsed = time.perf_counter() - start_time
+
+        results[backend] = {'latency': elapsed / max(len(crops), 1),
+                            'cer': character_error_rate(predictions, truths)}
+        print(f"{backend}: {results[backend]['latency'] * 1000:.1f} ms/crop | CER: {results[backend]['cer']:.4f}")
+    return results
+
+def main():
+    # python -m src.benchmark.trocr_benchmark -manifest <table_correspondance.ods> -nb_files 10
+    parser = argparse.ArgumentParser(description='Latency and character error rate of the TrOCR backends.')
+    parser.add_argument('-manifest', metavar='MANIFEST_PATH', type=str, default='../../Data/POC/table_correspondance_90pourcents.ods', help='Table de correspondance SPI / images')
+    parser.add_argument('-verite_terrain', metavar='VERITE_TERRAIN_PATH', type=str, default='data/excel/verite_terrain.ods', help='Vérité terrain')
+    parser.add_argument('-models', metavar='MODELS_PATH', type=str, default='./data/forms_ref', help='Formulaires de référence')
+    parser.add_argument('-nb_files', metavar='NB_FILES', type=int, default=10, help='Nombre de formulaires à traiter')
+    parser.add_argument('-nb_ocr', metavar='NB_OCR', type=int, default=50, help='Nombre de champs par page')
+    parser.add_argument('-backends', metavar='BACKENDS', type=str, default='eager,int8', help=f"Backends à comparer parmi {','.join(TROCR_BACKENDS)}, séparés par des virgules (onnx nécessite optimum et onnxruntime)")
+    parser.add_argument('-batch_size', metavar='BATCH_SIZE', type=int, default=16, help='Nombre de champs par batch')
+    parser.add_argument('-threads', metavar='THREADS', type=int, default=None, help='Nombre de threads PyTorch')
+    args = parser.parse_args()
+
+    fields = collect_fields(args.manifest, args.verite_terrain, args.models, args.nb_files, args.nb_ocr)
+    print(f"==> {len(fields)} fields with a ground truth.")
+    run_trocr_benchmark(fields, args.backends.split(','), args.batch_size, args.threads)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# load_template
+# on_white_paper
+# field_ink
+# split_blank_fields
+
+import os
+import functools
+import cv2
+import numpy as np
+from PIL import Image
+from src.process.process import load_page
+
+# Share of new ink (pixels darker than the reference form) under which a field is blank. On the filled
+# samples of data/forms_ref, the blank fields stay under it (stray strokes of the next fields) and
+# the smallest written ones, a short typed name, are over 0.004.
+BLANK_INK_THRESHOLD = 0.002
+# A pixel is ink when it is this many gray levels darker than the reference, both brought to white paper.
+# Pen strokes are often between 140 and 190, a fixed threshold at 128 misses them.
+INK_CONTRAST = 50
+# Gray level of the paper of a crop: most of a field is paper, even when filled.
+PAPER_PERCENTILE = 90
+# Printed lines of the reference are widened by this many pixels to absorb alignment errors.
+TEMPLATE_TOLERANCE = 2
+
+# Fields seen and OCR calls skipped since the start of the process.
+blank_field_stats = {'fields': 0, 'skipped': 0}
+
+@functools.lru_cache(maxsize=None)
+def load_template(match_form, path_models='./data/forms_ref'):
+    """
+    Reference form at the alignment resolution, each pixel replaced by the darkest one within
+    TEMPLATE_TOLERANCE so that printed lines and text are widened. Outside the page the crops
+    are black, like printed parts, so that their borders are not counted as ink.
+    """
+    page = load_page(os.path.join(path_models, match_form, f"{match_form}.jpg"))
+    size = 2 * TEMPLATE_TOLERANCE + 1
+    return Image.fromarray(cv2.erode(page, np.ones((size, size), np.uint8)))
+
+def on_white_paper(image):
+    """Gray levels of an image scaled so that its paper (PAPER_PERCENTILE) is white, as float32."""
+    image = np.float32(image)
+    return np.minimum(image * 255 / max(np.percentile(image, PAPER_PERCENTILE), 1), 255)
+
+def field_ink(fields, template_fields):
+    """
+    Share of ink of each field that is not printed on the reference form: pixels INK_CONTRAST
+    darker than the reference, after the paper of both is brought to white, so that the
+    measure follows the scan and not a fixed gray level.
+
+    :param fields: list of (label, cropped) of the aligned page.
+    :param template_fields: dict label -> crop of the same box in the reference of load_template.
+    :return: numpy array, one ratio per field.
+    """
+    ratios = np.zeros(len(fields), dtype=np.float32)
+    for i, (label, cropped) in enumerate(fields):
+        template = np.asarray(template_fields[label])
+        if template.size == 0:
+            continue
+        crop = np.asarray(cropped.convert('L'))
+        if crop.shape != template.shape:
+            # Full resolution crops are compared at the alignment resolution.
+            crop = cv2.resize(crop, (template.shape[1], template.shape[0]), interpolation=cv2.INTER_AREA)
+        ratios[i] = np.count_nonzero(on_white_paper(crop) < on_white_paper(template) - INK_CONTRAST) / crop.size
+    return ratios
+
+def split_blank_fields(fields, template_fields, threshold=BLANK_INK_THRESHOLD):
+    """
+    Find the fields left blank by comparing their ink with the reference form.
+
+    :param fields: list of (label, cropped), as returned by crop_fields.
+    :param template_fields: dict label -> crop of the same box in the reference of load_template.
+    :return: (dict label -> "" of the blank fields, dict label -> confidence in [0, 1]
+        that the field is blank, list of (label, cropped) of the other fields)
+    """
+    ratios = field_ink(fields, template_fields)
+
+    values, confidences, text_fields = {}, {}, []
+    for (label, cropped), ratio in zip(fields, ratios):
+        if ratio < threshold:
+            values[label] = ""
+            confidences[label] = float(1 - ratio / threshold)
+        else:
+            text_fields.append((label, cropped))
+
+    blank_field_stats['fields'] += len(fields)
+    blank_field_stats['skipped'] += len(values)
+    return values, confidences, text_fields
+
+def blank_field_report():
+    """Summary of the OCR calls skipped so far."""
+    fields, skipped = blank_field_stats['fields'], blank_field_stats['skipped']
+    return f"{skipped}/{fields} blank fields skipped ({100 * skipped / max(fields, 1):.1f}% of the OCR calls)."
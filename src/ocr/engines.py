@@ -0,0 +1,109 @@
+# OCREngine
+# register_engine
+# get_engine
+# crop_fields
+# dispatch
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+from src.process.process import ALIGNMENT_SIZE
+from src.ocr.field_templates import compile_field_template
+
+class OCREngine(object):
+    """ Interface of the OCR engines: recognize_batch(crops, field_meta) gives the text
+    of each crop, or None when the engine failed on it (written as "" but not cached),
+    field_meta being one dict per crop ('label' and the settings of the field).
+
+    concurrency tells dispatch how to spread the crops of a page:
+    'thread' for engines waiting on the network or on native code releasing the GIL,
+    'batch' for engines batching internally, called once with every crop.
+    remote is True for the engines waiting on a remote service: run_pipeline then
+    keeps the OCR of several forms in flight. """
+    name = None
+    concurrency = 'batch'
+    remote = False
+    chunk_size = 1 # Crops per recognize_batch call with 'thread'.
+    max_workers = None # Default: one per core.
+
+    def recognize_batch(self, crops, field_meta):
+        raise NotImplementedError
+
+    def config(self):
+        """Settings that change the results of the engine, part of the OCR cache keys."""
+        return {}
+
+    def field_config(self, field_type):
+        """Settings of the fields of a type ('text', 'amount', 'digits'...), given in field_meta."""
+        return {}
+
+_engines = {}
+
+def register_engine(name, factory):
+    """Make an engine available to draw_boxes under a name, factory(**options) -> OCREngine."""
+    _engines[name] = factory
+
+def get_engine(name, **options):
+    """
+    Create the engine registered under name. Each engine takes the options it knows
+    (model, processor, mosaic, lang...) and ignores the others.
+    """
+    if name not in _engines:
+        raise ValueError(f"Unknown OCR engine '{name}', expected one of {available_engines()}.")
+    return _engines[name](**options)
+
+def available_engines():
+    return sorted(_engines)
+
+def crop_fields(image, template, nb_ocr, padding=5):
+    """
+    Crop the labelled fields of an aligned image.
+
+    :param template: fields of the form, as returned by load_field_template
+        (the Label Studio json of the form is compiled on the fly).
+    :return: list
+        (label, cropped PIL image) of the first nb_ocr labelled fields, each label once.
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    elif isinstance(image, str):
+        image = Image.open(image)
+    if not isinstance(template, np.ndarray):
+        template = compile_field_template(template)
+
+    template = template[:max(nb_ocr, 0)]
+    # Boxes of the template are at the alignment resolution, scaled to the image (full resolution).
+    scale = np.array([image.width / ALIGNMENT_SIZE[0], image.height / ALIGNMENT_SIZE[1]] * 2)
+    boxes = np.stack([template['x0'], template['y0'], template['x1'], template['y1']], axis=1) * scale
+    boxes += np.array([-padding, -padding, padding, padding])
+
+    return [(label, image.crop(tuple(box))) for label, box in zip(template['label'].tolist(), boxes.tolist())]
+
+def _recognize_chunk(task):
+    engine, crops, field_meta = task
+    return engine.recognize_batch(crops, field_meta)
+
+def dispatch(engine, crops, field_meta=None):
+    """
+    Recognise crops with an engine, following its concurrency model.
+
+    :return: list of str, in the order of crops.
+    """
+    if not crops:
+        return []
+    if field_meta is None:
+        field_meta = [{} for _ in crops]
+
+    if engine.concurrency == 'batch':
+        return list(engine.recognize_batch(crops, field_meta))
+
+    size = engine.chunk_size
+    chunks = [(engine, crops[i:i + size], field_meta[i:i + size]) for i in range(0, len(crops), size)]
+    if engine.concurrency == 'thread':
+        with ThreadPoolExecutor(max_workers=min(engine.max_workers or os.cpu_count() or 1, len(chunks))) as executor:
+            results = list(executor.map(_recognize_chunk, chunks))
+    else:
+        raise ValueError(f"Unknown concurrency '{engine.concurrency}' of the OCR engine {engine.name}.")
+
+    return [text for texts in results for text in texts]
@@ -0,0 +1,103 @@
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import grpc
+from PIL import Image
+from google.cloud.vision_v1 import types
+from google.rpc import status_pb2
+
+from src.ocr.ocr_google import EMULATOR_HOST_ENV, reset_client_pool
+
+SERVICE_NAME = 'google.cloud.vision.v1.ImageAnnotator'
+
+def image_size_text(content):
+    """Default answer of the fake server: the size of the received image."""
+    width, height = Image.open(BytesIO(content)).size
+    return f"{width}x{height}"
+
+class FakeVisionServer(object):
+    """ Local gRPC server answering ImageAnnotator.BatchAnnotateImages requests, so
+    the Google OCR path can be run without credentials nor network.
+
+    Used as a context manager, it points ocr_google at itself:
+
+        with FakeVisionServer() as server:
+            texts = recognize_fields('google', fields)
+        print(server.nb_requests, server.nb_images)
+    """
+    def __init__(self, text_for_image=image_size_text, host='127.0.0.1', port=0):
+        # text_for_image(content) -> str, list of types.EntityAnnotation, or a google.rpc Status for a per-image error.
+        self.text_for_image = text_for_image
+        self.nb_requests = 0
+        self.nb_images = 0
+        self._server = grpc.server(ThreadPoolExecutor(max_workers=8))
+        handler = grpc.method_handlers_generic_handler(SERVICE_NAME, {
+            'BatchAnnotateImages': grpc.unary_unary_rpc_method_handler(
+                self._batch_annotate_images,
+                request_deserializer=types.BatchAnnotateImagesRequest.deserialize,
+                response_serializer=types.BatchAnnotateImagesResponse.serialize,
+            ),
+        })
+        self._server.add_generic_rpc_handlers((handler,))
+        self.port = self._server.add_insecure_port(f'{host}:{port}')
+        self.address = f'{host}:{self.port}'
+        self._previous_host = None
+
+    def _batch_annotate_images(self, request, context):
+        self.nb_requests += 1
+        self.nb_images += len(request.requests)
+        responses = []
+        for image_request in request.requests:
+            text = self.text_for_image(image_request.image.content)
+            if isinstance(text, status_pb2.Status):
+                responses.append(types.AnnotateImageResponse(error=text))
+                continue
+            # text_for_image gives the whole text, or every annotation (whole text then words).
+            if isinstance(text, list):
+                annotations = text
+            else:
+                annotations = [types.EntityAnnotation(description=text)] if text else []
+            responses.append(types.AnnotateImageResponse(text_annotations=annotations))
+        return types.BatchAnnotateImagesResponse(responses=responses)
+
+    def start(self):
+        self._server.start()
+        return self
+
+    def stop(self):
+        self._server.stop(grace=None)
+
+    def __enter__(self):
+        self.start()
+        self._previous_host = os.environ.get(EMULATOR_HOST_ENV)
+        os.environ[EMULATOR_HOST_ENV] = self.address
+        reset_client_pool()
+        return self
+
+    def __exit__(self, *exc):
+        if self._previous_host is None:
+            os.environ.pop(EMULATOR_HOST_ENV, None)
+        else:
+            os.environ[EMULATOR_HOST_ENV] = self._previous_host
+        reset_client_pool()
+        self.stop()
+
+def main():
+    # python -m src.ocr.fake_vision -port 8085, then VISION_EMULATOR_HOST=127.0.0.1:8085
+    parser = argparse.ArgumentParser(description='Serveur Google Vision local pour les tests.')
+    parser.add_argument('-port', metavar='PORT', type=int, default=8085, help='Port du serveur')
+    args = parser.parse_args()
+
+    server = FakeVisionServer(port=args.port).start()
+    print(f"Fake Vision server listening on {server.address}, set {EMULATOR_HOST_ENV}={server.address}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
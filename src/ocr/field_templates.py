@@ -0,0 +1,72 @@
+# field_template_dtype
+# compile_field_template
+# load_field_template
+
+import os
+import json
+import functools
+import numpy as np
+from src.process.process import ALIGNMENT_SIZE
+from src.ocr.field_types import field_types
+
+def field_template_dtype(label_size=8):
+    """One row per field, boxes in pixels of the reference form at the alignment resolution.
+    The labels are stored on label_size characters, the types ('checkbox' at most) on 8."""
+    return np.dtype([
+        ('label', f'U{label_size}'),
+        ('x0', 'f8'), ('y0', 'f8'), ('x1', 'f8'), ('y1', 'f8'),
+        ('type', 'U8'),
+    ])
+
+FIELD_TEMPLATE_DTYPE = field_template_dtype()
+
+def compile_field_template(json_data, types=None, size=ALIGNMENT_SIZE):
+    """
+    Turn the Label Studio annotations of a form into a structured array of its fields.
+
+    :param json_data: Content of json_labels/<form>.json.
+    :param types: dict label -> field type ('text' when missing).
+    :param size: (width, height) the boxes are computed for.
+    :return: numpy array of field_template_dtype, its labels as wide as the longest one. The fields keep
+        the order of the boxes in the Label Studio json (crop_fields and nb_ocr follow it), each label once,
+        at its first box.
+    """
+    types = types or {}
+    width, height = size
+    rows = []
+    labels = set()
+    for item in json_data:
+        for annotation in item['annotations']:
+            for result in annotation['result']:
+                # Label Studio gives each box twice, as a 'rectangle' and with its 'labels'.
+                if result['type'] != 'labels':
+                    continue
+
+                value = result['value']
+                label = value['labels'][0]
+                if label in labels:
+                    continue
+
+                x = value['x'] * width / 100
+                y = value['y'] * height / 100
+                rows.append((label, x, y, x + value['width'] * width / 100, y + value['height'] * height / 100,
+                             types.get(label, 'text')))
+                labels.add(label)
+
+    # Les libellés ne sont jamais tronqués, même au-delà de 8 caractères.
+    return np.array(rows, dtype=field_template_dtype(max([len(row[0]) for row in rows], default=8)))
+
+# A few versions of each form, the old ones being dropped.
+@functools.lru_cache(maxsize=32)
+def _load_field_template(match_form, json_path, mtime, types):
+    with open(json_path, 'r') as json_file:
+        json_data = json.load(json_file)
+    template = compile_field_template(json_data, dict(types))
+    template.flags.writeable = False
+    return template
+
+def load_field_template(match_form, base_path='json_labels'):
+    """Compiled fields of a form, compiled once and again only when its json file or the types of its fields change."""
+    json_path = os.path.join(base_path, f"{match_form}.json")
+    types = tuple(sorted(field_types(match_form).items()))
+    return _load_field_template(match_form, json_path, os.path.getmtime(json_path), types)
@@ -0,0 +1,104 @@
+# sheet_labels
+# field_types
+# classify_checkboxes
+# split_checkboxes
+
+import os
+import re
+import functools
+import cv2
+import numpy as np
+from openpyxl import load_workbook
+from openpyxl.utils import get_column_letter
+from src.process.process import choose_good_excel
+
+# Acquisition workbook whose second row holds the label of each column, as in the ground truth.
+FIELD_LABELS_PATH = './data/excel/Acquisition.xlsx'
+# Columns read as amounts (tax boxes such as '1AJ' or '2CH pré imp') and as numbers.
+AMOUNT_LABEL_PATTERN = re.compile(r'^\s*\d[A-Z]{2}\b')
+DIGITS_LABEL_PATTERN = re.compile(r'code postal|t[ée]l[ée]phone|spi|fiscal|fip|ann[ée]e de naissance', re.IGNORECASE)
+
+# Value written for a checked box, as in the ground truth.
+CHECKBOX_CHECKED = "X"
+# Share of dark pixels inside a box above which it is checked.
+CHECKBOX_INK_THRESHOLD = 0.02
+# Size the crops are resized to, and share of each side ignored to drop the printed frame.
+CHECKBOX_SIZE = 32
+CHECKBOX_MARGIN = 0.25
+
+@functools.lru_cache(maxsize=None)
+def _sheet_labels(sheet_name, path, mtime):
+    workbook = load_workbook(path, read_only=True)
+    try:
+        row = next(workbook[sheet_name].iter_rows(min_row=2, max_row=2, values_only=True), ())
+    finally:
+        workbook.close()
+    return {get_column_letter(i + 1): str(label) for i, label in enumerate(row) if label is not None}
+
+@functools.lru_cache(maxsize=None)
+def _warn_missing_labels(path):
+    print(f"Warning: {path} not found, every field is read as text (no checkbox, amount or digits field).")
+
+def sheet_labels(sheet_name, path=FIELD_LABELS_PATH):
+    """Label of each column of a sheet of the acquisition workbook, read again when the workbook changes.
+
+    :return: dict column letter (the field labels of json_labels) -> label, empty if the workbook is missing.
+    """
+    if not os.path.exists(path):
+        _warn_missing_labels(path)
+        return {}
+    return _sheet_labels(sheet_name, path, os.path.getmtime(path))
+
+def field_type(label):
+    """
+    Type of a field from the label of its column: 'checkbox' for the boxes to tick ('cochez'),
+    'amount' for the tax boxes, 'digits' for postcodes, phone and tax numbers, years, 'text' otherwise.
+    """
+    if 'cochez' in label.lower():
+        return 'checkbox'
+    if AMOUNT_LABEL_PATTERN.match(label):
+        return 'amount'
+    if DIGITS_LABEL_PATTERN.search(label):
+        return 'digits'
+    return 'text'
+
+def field_types(match_form, path=FIELD_LABELS_PATH):
+    """
+    Type of each field of a form, from the labels of the columns of its sheet.
+
+    :return: dict label -> type, for the fields that are not 'text'.
+    """
+    types = {column: field_type(label) for column, label in sheet_labels(choose_good_excel(match_form), path).items()}
+    return {column: kind for column, kind in types.items() if kind != 'text'}
+
+def classify_checkboxes(crops, threshold=CHECKBOX_INK_THRESHOLD):
+    """
+    Tell checked boxes from empty ones by their ink density, all the crops at once.
+
+    :param crops: list of PIL images of checkbox fields.
+    :return: list of str, CHECKBOX_CHECKED or "" for each crop.
+    """
+    if not crops:
+        return []
+
+    boxes = np.stack([cv2.resize(np.asarray(crop.convert('L')), (CHECKBOX_SIZE, CHECKBOX_SIZE), interpolation=cv2.INTER_AREA)
+                      for crop in crops])
+    margin = int(CHECKBOX_SIZE * CHECKBOX_MARGIN)
+    inner = boxes[:, margin:CHECKBOX_SIZE - margin, margin:CHECKBOX_SIZE - margin]
+    ink = (inner < 128).mean(axis=(1, 2))
+    return [CHECKBOX_CHECKED if density > threshold else "" for density in ink]
+
+def split_checkboxes(fields, match_form, types=None):
+    """
+    Classify the checkbox fields of a page without OCR.
+
+    :param fields: list of (label, cropped), as returned by crop_fields.
+    :param types: dict label -> type of the fields, e.g. of the compiled template; field_types(match_form) if None.
+    :return: (dict label -> value of the checkbox fields, list of (label, cropped) of the other fields)
+    """
+    if types is None:
+        types = field_types(match_form)
+    checkboxes = [(label, cropped) for label, cropped in fields if types.get(label) == 'checkbox']
+    text_fields = [(label, cropped) for label, cropped in fields if types.get(label) != 'checkbox']
+    values = classify_checkboxes([cropped for _, cropped in checkboxes])
+    return {label: value for (label, _), value in zip(checkboxes, values)}, text_fields
@@ -0,0 +1,121 @@
+# OCRCache
+# cache_report
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+OCR_CACHE_PATH = './data/ocr_cache.sqlite'
+OCR_CACHE_MAX_ENTRIES = 500000
+# An eviction keeps this share of max_entries, the table is counted again only once it may be full.
+OCR_CACHE_EVICTION_TARGET = 0.9
+
+class OCRCache(object):
+    """ Texts already recognised, stored in a sqlite file and keyed by a hash of the
+    crop pixels, the OCR engine and its settings. When the cache holds more than
+    max_entries texts, the least recently used ones are evicted.
+
+    The size is tracked by a counter, the table being counted only when the counter
+    goes over max_entries. Texts stored by other processes are not in the counter,
+    they are found at that count.
+
+    Safe to share between threads; each process opens its own connection. """
+    def __init__(self, path=OCR_CACHE_PATH, max_entries=OCR_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS ocr_cache (key TEXT PRIMARY KEY, text TEXT NOT NULL, last_used REAL NOT NULL)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS ocr_cache_last_used ON ocr_cache (last_used)")
+        # Upper bound of the number of texts, a replaced key being counted as a new one.
+        self._size = self._count()
+
+    def _count(self):
+        return self._connection.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0]
+
+    @staticmethod
+    def key(cropped, engine, config=None):
+        """Hash of the crop pixels, the engine name and its settings."""
+        digest = hashlib.sha256()
+        digest.update(f"{engine}|{json.dumps(config or {}, sort_keys=True)}|{cropped.mode}|{cropped.size}|".encode())
+        digest.update(cropped.tobytes())
+        return digest.hexdigest()
+
+    def get_many(self, keys):
+        """
+        :return: dict key -> text of the keys found in the cache.
+        """
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                found.update(self._connection.execute(
+                    f"SELECT key, text FROM ocr_cache WHERE key IN ({placeholders})", chunk).fetchall())
+            if found:
+                with self._connection:
+                    self._connection.executemany("UPDATE ocr_cache SET last_used = ? WHERE key = ?",
+                                                 [(time.time(), key) for key in found])
+            self.hits += sum(key in found for key in keys)
+            self.misses += sum(key not in found for key in keys)
+        return found
+
+    def put_many(self, items):
+        """Store (key, text) pairs. Above max_entries texts, the least recently used ones
+        are evicted down to OCR_CACHE_EVICTION_TARGET of max_entries."""
+        if not items:
+            return
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO ocr_cache (key, text, last_used) VALUES (?, ?, ?)",
+                                         [(key, text, now) for key, text in items])
+            self._size += len(items)
+            if self._size <= self.max_entries:
+                return
+            self._size = self._count()
+            if self._size > self.max_entries:
+                excess = self._size - int(self.max_entries * OCR_CACHE_EVICTION_TARGET)
+                self._connection.execute("DELETE FROM ocr_cache WHERE key IN "
+                                         "(SELECT key FROM ocr_cache ORDER BY last_used LIMIT ?)", (excess,))
+                self._size -= excess
+
+    def report(self):
+        return cache_report(self.hits, self.misses)
+
+    def close(self):
+        self._connection.close()
+
+def cache_report(hits, misses):
+    """Summary of the hits and misses of one or several caches, e.g. summed over the workers of run_all."""
+    return f"OCR cache: {hits} hits, {misses} misses ({100 * hits / max(hits + misses, 1):.1f}% hits)."
+
+def cached_recognize(cache, recognize, fields, engine, config=None, field_configs=None):
+    """
+    Run recognize only on the fields missing from the cache and store their texts.
+
+    :param recognize: function list of (label, cropped) -> list of str, None for the
+        fields the engine failed on: they are not stored, the next run sends them again.
+    :param field_configs: dict label -> settings of the field, part of its key.
+    :return: list of str, one per field ("" for the failed ones).
+    """
+    if cache is None:
+        return [text or "" for text in recognize(fields)]
+
+    field_configs = field_configs or {}
+    keys = [OCRCache.key(cropped, engine, {**(config or {}), **field_configs.get(label, {})})
+            for label, cropped in fields]
+    found = cache.get_many(keys)
+
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    texts = recognize([fields[i] for i in missing]) if missing else []
+    cache.put_many([(keys[i], text) for i, text in zip(missing, texts) if text is not None])
+    found.update({keys[i]: text for i, text in zip(missing, texts)})
+    return [found[key] or "" for key in keys]
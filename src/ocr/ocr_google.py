@@ -1,71 +1,91 @@
 from google.cloud import vision_v1
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
 from google.oauth2 import service_account
 from google.cloud.vision_v1 import types
-import tqdm
+from concurrent.futures import ThreadPoolExecutor
+import grpc
+import itertools
+import threading
 import os
-import json
 from io import BytesIO
-import pandas as pd
 import numpy as np
-from PIL import Image, ImageDraw
-
-
-def draw_boxes_on_image_google(image, json_data, nb_ocr):
-    if isinstance(image, np.ndarray):
-        image = Image.fromarray(image)
-    elif isinstance(image, str):
-        image = Image.open(image)
-
-    strings = []
-    data_dict = {}
-
-    for item in json_data:
-        for annotation in item['annotations']:
-            for result in tqdm.tqdm(annotation['result'], desc='ocr process: '):
-                if result['type'] == 'labels':
-
-                    value = result['value']
-                    x, y, width, height = [value[key] * image.size[i % 2] / 100 for i, key in enumerate(['x', 'y', 'width', 'height'])]
-
-                    padding = 5
-                    cropped = image.crop((x - padding, y - padding, x + width + padding, y + height + padding))
-
-                    if len(strings) < nb_ocr:
-                        extracted_text = extract_text_from_image_google(cropped)
-                        strings.append(extracted_text)
-
-                        if value['labels'][0] not in data_dict:
-                            data_dict[value['labels'][0]] = extracted_text
-    
-    df = pd.DataFrame([data_dict])
-    return image, strings, df
-
-def extract_text_from_image_google(image, language_hints='fr-t-i0-handwrit', bounding_poly=None):
+from PIL import Image
+from src.ocr.engines import OCREngine, register_engine
+
+
+# Path of the service account key file.
+CREDENTIALS_PATH = 'CHEMIN_VERS_VOTRE_CREDENTIALS_JSON'
+# Maximum number of images in one batch_annotate_images request (API limit).
+MAX_IMAGES_PER_REQUEST = 16
+# Number of clients, each one with its own gRPC channel.
+CLIENT_POOL_SIZE = 4
+# host:port of a local Vision server (see fake_vision.py), used instead of Google Cloud.
+EMULATOR_HOST_ENV = 'VISION_EMULATOR_HOST'
+# Size of the composite images of the mosaic mode and white margin between two crops.
+MOSAIC_MAX_SIZE = (2048, 2048)
+MOSAIC_GAP = 32
+
+_client_pool = []
+_client_pool_lock = threading.Lock()
+_next_client = itertools.count()
+
+def create_client(credentials=None):
+    emulator_host = os.environ.get(EMULATOR_HOST_ENV)
+    if emulator_host:
+        channel = grpc.insecure_channel(emulator_host)
+        return vision_v1.ImageAnnotatorClient(transport=ImageAnnotatorGrpcTransport(channel=channel))
+    return vision_v1.ImageAnnotatorClient(credentials=credentials)
+
+def get_client(credentials_path=CREDENTIALS_PATH):
     """
-    Extracts text from an image file using Google Cloud Vision API.
-
-    Parameters:
-        image_path (str): The path to the image file.
-        credentials_path (str): The path to the service account key file.
-        language_hints (list of str): Optional - BCP-47 language codes.
-        bounding_poly (list of dict): Optional - Vertices of the bounding polygon.
-
-    Returns:
-        str: Extracted text from the image.
+    Return a client of the module-level pool. The credentials are read and the
+    channels are opened once, on first use, then the clients are used in turn.
     """
-    credentials_path = 'CHEMIN_VERS_VOTRE_CREDENTIALS_JSON'
-
-    # Specify the path to the service account key file
-    credentials = service_account.Credentials.from_service_account_file(
-        credentials_path
-    )
-
-    # Instantiates a client
-    client = vision_v1.ImageAnnotatorClient(credentials=credentials)
-
-    content = image_to_byte_array(image)
-
-    image = types.Image(content=content)
+    with _client_pool_lock:
+        if not _client_pool:
+            credentials = None
+            if not os.environ.get(EMULATOR_HOST_ENV):
+                # Specify the path to the service account key file
+                credentials = service_account.Credentials.from_service_account_file(
+                    credentials_path
+                )
+            _client_pool.extend(create_client(credentials) for _ in range(CLIENT_POOL_SIZE))
+        return _client_pool[next(_next_client) % len(_client_pool)]
+
+def reset_client_pool():
+    """Drop the pooled clients, the next call to get_client creates new ones."""
+    with _client_pool_lock:
+        _client_pool.clear()
+
+class GoogleEngine(OCREngine):
+    """ Google Cloud Vision, up to MAX_IMAGES_PER_REQUEST crops per request, the
+    requests being sent from threads over the client pool. With mosaic, the crops
+    of a page are tiled into a few images instead. """
+    name = 'google'
+    remote = True
+    chunk_size = MAX_IMAGES_PER_REQUEST
+    max_workers = CLIENT_POOL_SIZE
+
+    def __init__(self, mosaic=False, language_hints='fr-t-i0-handwrit', **options):
+        self.mosaic = mosaic
+        self.language_hints = language_hints
+        # The mosaics need every crop of the page at once.
+        self.concurrency = 'batch' if mosaic else 'thread'
+
+    def recognize_batch(self, crops, field_meta):
+        if self.mosaic:
+            return extract_texts_from_mosaics_google(crops, self.language_hints)
+        return _annotate_batch([build_annotate_request(cropped, self.language_hints) for cropped in crops])
+
+    def config(self):
+        return {'mosaic': self.mosaic}
+
+register_engine('google', GoogleEngine)
+
+def build_annotate_request(image, language_hints='fr-t-i0-handwrit', bounding_poly=None):
+    """Build the DOCUMENT_TEXT_DETECTION request of one image."""
+    if isinstance(language_hints, str):
+        language_hints = [language_hints]
 
     # Prepare image context using language hints and bounding polygon if provided
     image_context = types.ImageContext(
@@ -75,16 +95,133 @@ def extract_text_from_image_google(image, language_hints='fr-t-i0-handwrit', bou
         ) if bounding_poly else None
     )
 
-    # Performs text detection on the image file
-    response = client.document_text_detection(image=image, image_context=image_context)
-    texts = response.text_annotations
+    return types.AnnotateImageRequest(
+        image=types.Image(content=image_to_byte_array(image)),
+        features=[types.Feature(type_=types.Feature.Type.DOCUMENT_TEXT_DETECTION)],
+        image_context=image_context,
+    )
+
+def _annotate_responses(requests):
+    response = get_client().batch_annotate_images(requests=requests)
+    for image_response in response.responses:
+        if image_response.error.code:
+            print(f"Google Vision error: {image_response.error.message}")
+    return list(response.responses)
+
+def _response_text(image_response):
+    # None when Vision failed on the image (quota, deadline, invalid image): nothing was read, the field is not blank.
+    if image_response.error.code:
+        return None
+    return image_response.text_annotations[0].description if image_response.text_annotations else ""
+
+def _annotate_batch(requests):
+    return [_response_text(image_response) for image_response in _annotate_responses(requests)]
+
+def _send_batches(requests, annotate, max_images_per_request=MAX_IMAGES_PER_REQUEST):
+    batches = [requests[i:i + max_images_per_request] for i in range(0, len(requests), max_images_per_request)]
+    with ThreadPoolExecutor(max_workers=CLIENT_POOL_SIZE) as executor:
+        results = executor.map(annotate, batches)
+    return [result for batch_results in results for result in batch_results]
+
+def build_mosaics(images, max_width=MOSAIC_MAX_SIZE[0], max_height=MOSAIC_MAX_SIZE[1], gap=MOSAIC_GAP):
+    """
+    Pack images into a few white composite images, shelf by shelf, tallest first.
+
+    Parameters:
+        images (list of PIL.Image): The field crops.
+        max_width, max_height (int): Size of a mosaic, a wider crop gets a mosaic of its own width.
+        gap (int): White margin between two tiles, so that the words of two fields are not merged.
+
+    Returns:
+        list of (PIL.Image, numpy.ndarray): Each mosaic and its tiles, one row
+        (image index, left, upper, right, lower) per crop placed in it.
+    """
+    order = sorted(range(len(images)), key=lambda i: -images[i].height)
+    layouts = []
+    tiles, x, y, shelf_height = [], gap, gap, 0
+
+    for i in order:
+        w, h = images[i].size
+        if x > gap and x + w + gap > max_width:
+            # Next shelf.
+            x, y, shelf_height = gap, y + shelf_height + gap, 0
+        if tiles and y + h + gap > max_height:
+            layouts.append(tiles)
+            tiles, x, y, shelf_height = [], gap, gap, 0
+        tiles.append((i, x, y, x + w, y + h))
+        x += w + gap
+        shelf_height = max(shelf_height, h)
+    if tiles:
+        layouts.append(tiles)
+
+    mosaics = []
+    for tiles in layouts:
+        width = max(right for _, _, _, right, _ in tiles) + gap
+        height = max(lower for _, _, _, _, lower in tiles) + gap
+        mosaic = Image.new('RGB', (width, height), 'white')
+        for i, left, upper, _, _ in tiles:
+            mosaic.paste(images[i].convert('RGB'), (left, upper))
+        mosaics.append((mosaic, np.array(tiles, dtype=np.int64)))
+    return mosaics
+
+def assign_words_to_tiles(image_response, tiles, gap=MOSAIC_GAP):
+    """
+    Split the words found in a mosaic between its tiles, from the center of their boxes.
+
+    Returns:
+        dict: image index -> text of its tile, lines separated by '\\n'.
+    """
+    words = image_response.text_annotations[1:] # The first annotation is the whole text.
+    texts = {int(i): "" for i in tiles[:, 0]}
+    if not words:
+        return texts
+
+    boxes = np.array([[(v.x, v.y) for v in word.bounding_poly.vertices] for word in words], dtype=np.float32)
+    centers = boxes.mean(axis=1)
+    # A word in the margin goes to the closest tile.
+    margin = gap / 2
+    inside = ((centers[:, 0:1] >= tiles[:, 1] - margin) & (centers[:, 0:1] < tiles[:, 3] + margin) &
+              (centers[:, 1:2] >= tiles[:, 2] - margin) & (centers[:, 1:2] < tiles[:, 4] + margin))
+
+    last_bottom = {}
+    for word, center, box, word_tiles in zip(words, centers, boxes, inside):
+        if not word_tiles.any():
+            continue
+        i = int(tiles[np.argmax(word_tiles), 0])
+        if texts[i]:
+            # The words come in reading order, a word below the previous one starts a line.
+            texts[i] += '\n' if center[1] > last_bottom[i] else ' '
+        texts[i] += word.description
+        last_bottom[i] = box[:, 1].max()
+    return texts
+
+def extract_texts_from_mosaics_google(images, language_hints='fr-t-i0-handwrit', max_images_per_request=MAX_IMAGES_PER_REQUEST):
+    """
+    Extracts the text of several crops tiled into a few mosaics: each mosaic is one
+    billable image instead of one per field. The mosaics are sent in batch_annotate_images
+    requests of up to max_images_per_request images, in parallel over the client pool,
+    and the words are given back to the fields from their position in the mosaic.
+
+    Returns:
+        list of str: Extracted text of each image, in the same order, None for the
+        images of a mosaic Vision failed on.
+    """
+    if not images:
+        return []
+
+    mosaics = build_mosaics(images)
+    print(f"Google Vision mosaic: {len(images)} fields in {len(mosaics)} images.")
+    requests = [build_annotate_request(mosaic, language_hints) for mosaic, _ in mosaics]
+    responses = _send_batches(requests, _annotate_responses, max_images_per_request)
+
+    texts = {}
+    for (_, tiles), image_response in zip(mosaics, responses):
+        if image_response.error.code:
+            texts.update({int(i): None for i in tiles[:, 0]})
+        else:
+            texts.update(assign_words_to_tiles(image_response, tiles))
+    return [texts[i] for i in range(len(images))]
 
-    # Extract and return the text from the response
-    if texts:
-        return texts[0].description
-    else:
-        return "" # No text found in the image.
-    
 def image_to_byte_array(image: Image.Image) -> bytes:
     img_byte_arr = BytesIO()
     image = image.convert('RGB')
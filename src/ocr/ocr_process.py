@@ -1,29 +1,127 @@
-import os
-import json
-from io import BytesIO
 import pandas as pd
-import numpy as np
-from PIL import Image, ImageDraw
-import tqdm
-from src.ocr.ocr_trocr import draw_boxes_on_image_trocr
-from src.ocr.ocr_google import draw_boxes_on_image_google
-from src.ocr.ocr_tesseract import draw_boxes_on_image_tesseract
-
-def draw_boxes(ocr, img_path, good_forms, nb_ocr=0, model=None, processor=None):
-    base_path = "json_labels"
-    image_file_name = f"{good_forms}.json"
-    
-    full_path_json = os.path.join(base_path, image_file_name)
-    with open(full_path_json, 'r') as json_file:
-        data = json.load(json_file)
-    
+import time
+from src.ocr.engines import get_engine, crop_fields, dispatch
+# Importing the engines registers them.
+from src.ocr import ocr_google, ocr_trocr, ocr_tesseract
+from src.ocr.ocr_trocr import TROCR_BATCH_SIZE
+from src.ocr.field_types import split_checkboxes
+from src.ocr.blank_fields import BLANK_INK_THRESHOLD, load_template, split_blank_fields
+from src.ocr.ocr_cache import cached_recognize
+from src.ocr.field_templates import load_field_template
+
+# (good_forms, path_models) -> (compiled template, crops of its reference form).
+_template_fields = {}
+
+def load_template_fields(good_forms, template, path_models='./data/forms_ref'):
+    """Every field of the blank reference form, cropped from the reference of load_template,
+    again when the compiled fields of the form change.
+
+    :param template: fields of the form, as returned by load_field_template: the same
+        array until its json or the types of its fields change.
+    """
+    key = (good_forms, path_models)
+    cached = _template_fields.get(key)
+    if cached is None or cached[0] is not template:
+        cached = (template, dict(crop_fields(load_template(good_forms, path_models), template, len(template))))
+        _template_fields[key] = cached
+    return cached[1]
+
+def template_types(template):
+    """dict label -> type of each field of a compiled template."""
+    return dict(zip(template['label'].tolist(), template['type'].tolist()))
+
+def filter_fields(fields, good_forms, template, checkboxes=True, blank_threshold=BLANK_INK_THRESHOLD, path_models='./data/forms_ref'):
+    """
+    Fill the fields that need no OCR: checkboxes and, if blank_threshold, blank fields.
+    The blank fields are found with the reference form of path_models.
+
+    :param template: fields of the form, as returned by load_field_template.
+    :return: (dict label -> value, dict label -> confidence of the blank fields,
+        list of (label, cropped) of the fields to OCR)
+    """
+    values, confidences = {}, {}
+    if checkboxes:
+        values, fields = split_checkboxes(fields, good_forms, template_types(template))
+    if blank_threshold:
+        blank_values, confidences, fields = split_blank_fields(fields, load_template_fields(good_forms, template, path_models), blank_threshold)
+        values.update(blank_values)
+    return values, confidences, fields
+
+def recognize_fields(ocr, fields, model=None, processor=None, mosaic=False, field_configs=None, cache=None, engine_config=None,
+                     batch_size=TROCR_BATCH_SIZE, field_types=None):
+    """
+    Run one OCR engine of the registry on the cropped fields of a page, with the
+    concurrency model of the engine.
+
+    :param fields: list of (label, cropped).
+    :param field_configs: dict label -> settings of the field, e.g. tesseract TESSERACT_PRESETS.
+    :param cache: OCRCache or None, only the crops missing from it are sent to the engine.
+    :param engine_config: settings of the engine that change its results (model, backend...), part of the cache keys.
+    :param batch_size: crops per TrOCR generate call.
+    :param field_types: dict label -> type of the field ('type' of the template), turned into settings
+        by the engine (e.g. the tesseract presets of the amounts); field_configs takes precedence.
+    :return: list of str, one per field.
+    """
+    engine = get_engine(ocr, model=model, processor=processor, mosaic=mosaic, batch_size=batch_size)
+    field_configs = {**{label: engine.field_config(kind) for label, kind in (field_types or {}).items()}, **(field_configs or {})}
+    field_configs = {label: config for label, config in field_configs.items() if config}
+
+    def recognize(fields):
+        return dispatch(engine, [cropped for _, cropped in fields],
+                        [{'label': label, **field_configs.get(label, {})} for label, _ in fields])
+
+    return cached_recognize(cache, recognize, fields, ocr, {**engine.config(), **(engine_config or {})}, field_configs)
+
+def prepare_fields(img_path, good_forms, nb_ocr=0, checkboxes=True, blank_threshold=BLANK_INK_THRESHOLD, path_models='./data/forms_ref',
+                   template=None):
+    """
+    Crop the fields of an aligned page once and fill those that need no OCR (see filter_fields).
+
+    :param template: fields of the form, as returned by load_field_template (loaded if None).
+    :return: (list of (label, cropped) of every field, dict label -> value,
+        dict label -> confidence of the blank fields, list of (label, cropped) of the fields to OCR)
+    """
+    if template is None:
+        template = load_field_template(good_forms)
+    fields = crop_fields(img_path, template, nb_ocr)
+    values, confidences, text_fields = filter_fields(fields, good_forms, template, checkboxes, blank_threshold, path_models)
+    return fields, values, confidences, text_fields
+
+def page_dataframe(fields, values, confidences, text_fields, strings):
+    """One row DataFrame of a page, from prepare_fields and the texts recognised for its text_fields."""
+    values = {**values, **{label: text for (label, _), text in zip(text_fields, strings)}}
+    df = pd.DataFrame([{label: values[label] for label, _ in fields}])
+    # Confidence that each skipped blank field is really empty, kept out of the Excel columns
+    # (see with_blank_confidence and ProgressJournal.done).
+    df.attrs['blank_confidence'] = confidences
+    return df
+
+def concat_pages(dfs):
+    """Row of a form, from the DataFrames of its pages (recto then verso)."""
+    df = pd.concat([df.reset_index(drop=True) for df in dfs], axis=1)
+    df.attrs['blank_confidence'] = {label: confidence for df in dfs for label, confidence in df.attrs.get('blank_confidence', {}).items()}
+    return df
+
+def with_blank_confidence(df):
+    """df with a '<label>_blank_conf' column per blank field skipped, after the field columns."""
+    confidences = df.attrs.get('blank_confidence', {})
+    columns = pd.DataFrame([{f"{label}_blank_conf": confidence for label, confidence in confidences.items()}], index=df.index[:1])
+    return pd.concat([df, columns], axis=1)
+
+def draw_boxes(ocr, img_path, good_forms, nb_ocr=0, model=None, processor=None, mosaic=False, checkboxes=True, blank_threshold=BLANK_INK_THRESHOLD,
+               cache=None, engine_config=None, batch_size=TROCR_BATCH_SIZE, path_models='./data/forms_ref'):
+    template = load_field_template(good_forms)
+
     print(ocr)
-    if ocr == 'google':
-        img, strings, df = draw_boxes_on_image_google(img_path, data, nb_ocr)
-    elif ocr == 'trocr':
-        img, strings, df = draw_boxes_on_image_trocr(img_path, data, nb_ocr, model, processor)
-    elif ocr == 'tesseract':
-        img, strings, df = draw_boxes_on_image_tesseract(img_path, data, nb_ocr)
+    start_time = time.time()
+
+    # Les champs sont découpés une seule fois, les cases à cocher et les champs vides sont remplis sans OCR.
+    fields, values, confidences, text_fields = prepare_fields(img_path, good_forms, nb_ocr, checkboxes, blank_threshold, path_models, template)
+
+    strings = recognize_fields(ocr, text_fields, model, processor, mosaic, cache=cache, engine_config=engine_config, batch_size=batch_size,
+                               field_types=template_types(template))
 
-    return img, strings, df
+    df = page_dataframe(fields, values, confidences, text_fields, strings)
+    print(f"==> {len(text_fields)}/{len(fields)} fields sent to {ocr}, {len(confidences)} blank fields skipped. Time taken: {time.time() - start_time:.2f} seconds.")
 
+    return img_path, strings, df
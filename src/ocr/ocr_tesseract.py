@@ -1,45 +1,104 @@
-import pandas as pd
-import numpy as np
-from PIL import Image, ImageDraw
-import time
-import tqdm
+import os
+import queue
+import threading
 import pytesseract
+from src.ocr.engines import OCREngine, register_engine
 
-def draw_boxes_on_image_tesseract(image, json_data, nb_ocr):
-    if isinstance(image, np.ndarray):
-        image = Image.fromarray(image)
-    elif isinstance(image, str):
-        image = Image.open(image)
-
-    draw = ImageDraw.Draw(image)
-    strings = []
-    data_dict = {}
-    images = []
-    labels_list = []
-    start = time.time()
-    i = 0
-
-    for item in json_data:
-        for annotation in item['annotations']:
-            for result in tqdm.tqdm(annotation['result'], desc='Select boxes for ocr'):
-                if result['type'] == 'labels':
-                    if i > nb_ocr:
-                        break
-                    value = result['value']
-                    x = value['x'] * image.width / 100
-                    y = value['y'] * image.height / 100
-                    width = value['width'] * image.width / 100
-                    height = value['height'] * image.height / 100
-                    padding = 5
-
-                    cropped = image.crop((x - padding, y - padding, x + width + padding, y + height + padding))
-                    images.append(cropped)
-                    labels = value['labels']
-                    if labels:
-                        extracted_text = pytesseract.image_to_string(cropped, lang='fra').strip()
-                        data_dict[labels[0]] = extracted_text
-                    i += 1
-
-    print(f'END TIME: {time.time() - start} secondes')
-    df = pd.DataFrame([data_dict])
-    return image, strings, df
+# Binding of the Tesseract C API (requirements.txt), without it each crop forks a tesseract process.
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# Per-field settings: page segmentation mode (None: tesseract default, 3) and character whitelist.
+TESSERACT_PRESETS = {
+    'text': {'psm': None, 'whitelist': None},
+    'digits': {'psm': 7, 'whitelist': '0123456789'},
+    'amount': {'psm': 7, 'whitelist': '0123456789 ,.'},
+}
+
+def tesseract_config(psm=None, whitelist=None):
+    """Command line options of pytesseract for a field."""
+    config = []
+    if psm is not None:
+        config.append(f'--psm {psm}')
+    if whitelist:
+        config.append(f'-c tessedit_char_whitelist={whitelist}')
+    return ' '.join(config)
+
+class TesseractPool(object):
+    """ Tesseract engines kept initialised, one per core by default, so that the traineddata is
+    loaded once. Uses tesserocr when it is installed (the engines run in threads,
+    tesserocr releases the GIL), otherwise one pytesseract process per crop. """
+    def __init__(self, lang='fra', size=None):
+        self.lang = lang
+        self.size = size or os.cpu_count() or 1
+        self.engines = None
+        self.backend = 'pytesseract'
+        if tesserocr is not None:
+            self.backend = 'tesserocr'
+            self.engines = queue.Queue()
+            for _ in range(self.size):
+                self.engines.put(tesserocr.PyTessBaseAPI(lang=lang))
+
+    def recognize(self, image, psm=None, whitelist=None):
+        """Text of one crop."""
+        if self.engines is None:
+            return pytesseract.image_to_string(image, lang=self.lang, config=tesseract_config(psm, whitelist)).strip()
+
+        api = self.engines.get()
+        try:
+            api.SetPageSegMode(tesserocr.PSM.AUTO if psm is None else psm)
+            api.SetVariable('tessedit_char_whitelist', whitelist or '')
+            api.SetImage(image)
+            return api.GetUTF8Text().strip()
+        finally:
+            api.Clear()
+            self.engines.put(api)
+
+    def close(self):
+        if self.engines is not None:
+            while not self.engines.empty():
+                self.engines.get().End()
+
+_pools = {}
+_pools_lock = threading.Lock()
+# Engines of the pools created from now on, None: one per core.
+_pool_size = None
+
+def set_tesseract_pool_size(size):
+    """Number of engines of the pools, e.g. the share of the cores of a worker process of run_all."""
+    global _pool_size
+    _pool_size = size
+
+def get_tesseract_pool(lang='fra'):
+    """Return the pool of the language, created on first use."""
+    with _pools_lock:
+        if lang not in _pools:
+            _pools[lang] = TesseractPool(lang, _pool_size)
+        return _pools[lang]
+
+class TesseractEngine(OCREngine):
+    """ Tesseract, one crop per task on the threads of dispatch, each task taking an
+    engine of the TesseractPool. The fields may set 'psm' and 'whitelist' in field_meta,
+    the amount and digits fields of the templates get the ones of TESSERACT_PRESETS. """
+    name = 'tesseract'
+    concurrency = 'thread'
+
+    def __init__(self, lang='fra', **options):
+        self.lang = lang
+        self.pool = get_tesseract_pool(lang)
+        self.max_workers = self.pool.size
+
+    def recognize_batch(self, crops, field_meta):
+        return [self.pool.recognize(cropped, meta.get('psm'), meta.get('whitelist'))
+                for cropped, meta in zip(crops, field_meta)]
+
+    def config(self):
+        # tesserocr and the tesseract command line may not read a crop the same way, their texts are cached apart.
+        return {'lang': self.lang, 'backend': self.pool.backend}
+
+    def field_config(self, field_type):
+        return {key: value for key, value in TESSERACT_PRESETS.get(field_type, {}).items() if value is not None}
+
+register_engine('tesseract', TesseractEngine)
@@ -1,8 +1,56 @@
-import pandas as pd
-import numpy as np
-from PIL import Image, ImageDraw
-import time
-import tqdm
+import os
+import torch
+import transformers
+from packaging import version
+from transformers import TrOCRProcessor, VisionEncoderDecoderModel
+from src.ocr.engines import OCREngine, register_engine
+
+TROCR_MODEL_NAME = "microsoft/trocr-small-handwritten"
+# eager: PyTorch fp32, int8: Linear layers quantized to int8, onnx: ONNX Runtime with KV cache.
+TROCR_BACKENDS = ['eager', 'int8', 'onnx']
+# The ONNX export is done once, then loaded from this folder.
+TROCR_ONNX_PATH = './data/trocr_onnx'
+# ORTModelForVision2Seq of optimum 1.x, which does not run with the transformers of requirements.txt.
+TROCR_ONNX_REQUIREMENTS = "'transformers>=4.36,<4.54' 'optimum[onnxruntime]>=1.16,<2'"
+# Crops run through generate at once.
+TROCR_BATCH_SIZE = 16
+
+def load_trocr_model(model_name=TROCR_MODEL_NAME, backend='eager', onnx_path=TROCR_ONNX_PATH):
+    """
+    Load the TrOCR model and processor with one of the TROCR_BACKENDS.
+
+    :param backend: 'eager', 'int8' or 'onnx'. 'onnx' needs TROCR_ONNX_REQUIREMENTS.
+    :return: (model, processor), model exposing generate.
+    """
+    if backend not in TROCR_BACKENDS:
+        raise ValueError(f"Unknown TrOCR backend '{backend}', expected one of {TROCR_BACKENDS}.")
+
+    if backend == 'onnx':
+        if not version.parse('4.36') <= version.parse(transformers.__version__) < version.parse('4.54'):
+            raise ImportError(f"The onnx TrOCR backend does not run with transformers {transformers.__version__}: "
+                              f"pip install {TROCR_ONNX_REQUIREMENTS}")
+        try:
+            from optimum.onnxruntime import ORTModelForVision2Seq
+        except ImportError:
+            raise ImportError(f"The onnx TrOCR backend needs optimum 1.x and onnxruntime: pip install {TROCR_ONNX_REQUIREMENTS}")
+
+    processor = TrOCRProcessor.from_pretrained(model_name)
+
+    if backend == 'onnx':
+        export_path = os.path.join(onnx_path, model_name.replace('/', '--'))
+        if os.path.isdir(export_path):
+            model = ORTModelForVision2Seq.from_pretrained(export_path, use_cache=True)
+        else:
+            print(f"==> Exporting {model_name} to ONNX in {export_path}...")
+            model = ORTModelForVision2Seq.from_pretrained(model_name, export=True, use_cache=True)
+            model.save_pretrained(export_path)
+        return model, processor
+
+    model = VisionEncoderDecoderModel.from_pretrained(model_name).eval()
+    if backend == 'int8':
+        # Poids des couches Linear en int8, activations quantifiées à la volée.
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model, processor
 
 def extract_text_from_image(cropped_image, model, processor):
 
@@ -10,47 +58,49 @@ def extract_text_from_image(cropped_image, model, processor):
     pixel_values = processor(cropped_image, return_tensors="pt").pixel_values
 
     # Générer les IDs à partir du modèle
-    generated_ids = model.generate(pixel_values, max_new_tokens=100)
+    with torch.inference_mode():
+        generated_ids = model.generate(pixel_values, max_new_tokens=100)
 
     # Décoder les IDs en texte
     generated_text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
 
     return generated_text.strip() or ""
 
-def draw_boxes_on_image_trocr(image, json_data, nb_ocr, model, processor):
-    if isinstance(image, np.ndarray):
-        image = Image.fromarray(image)
-    elif isinstance(image, str):
-        image = Image.open(image)
-
-    draw = ImageDraw.Draw(image)
-    strings = []
-    data_dict = {}
-    images = []
-    labels_list = []
-    start = time.time()
-    i = 0
-    for item in json_data:
-        for annotation in item['annotations']:
-            for result in tqdm.tqdm(annotation['result'], desc='Select boxes for ocr'):
-                if result['type'] == 'labels':
-                    if (i > nb_ocr):
-                        break
-                    value = result['value']
-                    x = value['x'] * image.width / 100
-                    y = value['y'] * image.height / 100
-                    width = value['width'] * image.width / 100
-                    height = value['height'] * image.height / 100
-                    padding = 5
-
-                    cropped = image.crop((x - padding, y - padding, x + width + padding, y + height + padding))
-                    images.append(cropped)
-                    labels = value['labels']
-                    if labels:
-                        extracted_text = extract_text_from_image(cropped, model, processor)
-                        data_dict[labels[0]] = extracted_text
-                    i+=1
-
-    print(f'END TIME: {time.time() - start} secondes')
-    df = pd.DataFrame([data_dict])
-    return image, strings, df
\ No newline at end of file
+def extract_texts_from_images(cropped_images, model, processor, batch_size=TROCR_BATCH_SIZE):
+    """
+    Same as extract_text_from_image on a list of crops, the crops being run through
+    the processor and generate batch_size at a time.
+
+    The processor resizes every crop to the same size, so the padding to limit is the
+    one of the generated sequences: crops are bucketed by aspect ratio, a proxy of the
+    text length, so that the sequences of a batch end at about the same step.
+
+    :return: list of str, in the order of cropped_images.
+    """
+    texts = [""] * len(cropped_images)
+    order = sorted(range(len(cropped_images)), key=lambda i: cropped_images[i].width / max(cropped_images[i].height, 1))
+
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        pixel_values = processor([cropped_images[i].convert('RGB') for i in batch], return_tensors="pt").pixel_values
+        with torch.inference_mode():
+            generated_ids = model.generate(pixel_values, max_new_tokens=100)
+        for i, generated_text in zip(batch, processor.batch_decode(generated_ids, skip_special_tokens=True)):
+            texts[i] = generated_text.strip() or ""
+
+    return texts
+
+class TrOCREngine(OCREngine):
+    """ TrOCR, every crop of the page in one call, batched by extract_texts_from_images. """
+    name = 'trocr'
+    concurrency = 'batch'
+
+    def __init__(self, model=None, processor=None, batch_size=TROCR_BATCH_SIZE, **options):
+        self.model = model
+        self.processor = processor
+        self.batch_size = batch_size
+
+    def recognize_batch(self, crops, field_meta):
+        return extract_texts_from_images(crops, self.model, self.processor, self.batch_size)
+
+register_engine('trocr', TrOCREngine)
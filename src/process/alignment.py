@@ -0,0 +1,59 @@
+# AlignedPage
+
+import cv2
+import numpy as np
+from PIL import Image
+
+class AlignedPage(object):
+    """ Page aligned on its reference form. Only the homography is kept: the fields
+    are warped one by one when cropped, instead of warping the whole page.
+
+    Behaves like the PIL image of the warped page for the OCR code: width, height,
+    size and crop((left, upper, right, lower)) are in reference coordinates. """
+    def __init__(self, page, H, image_path=None, full_resolution=False):
+        self.page = page # HxW uint8 grayscale page at the alignment resolution.
+        self.H = H # Homography from the page to the reference form.
+        self.image_path = image_path
+        self.full_resolution = full_resolution
+        self.height, self.width = page.shape
+        self.size = (self.width, self.height)
+        self._scan = None
+
+    def scan(self):
+        """Original scan at full resolution, decoded on first use."""
+        if self._scan is None:
+            self._scan = cv2.imread(self.image_path, cv2.IMREAD_GRAYSCALE)
+        return self._scan
+
+    def warp_box(self, box, full_resolution=None):
+        """
+        Warp only the pixels of a box of the reference form.
+
+        :param box: (left, upper, right, lower) in reference coordinates, rounded like PIL.
+        :param full_resolution: Sample the patch from the original scan instead of the page.
+        :return: uint8 grayscale patch.
+        """
+        if full_resolution is None:
+            full_resolution = self.full_resolution
+        left, upper, right, lower = [int(round(v)) for v in box]
+        width, height = max(right - left, 0), max(lower - upper, 0)
+        if width == 0 or height == 0:
+            return np.zeros((height, width), dtype=np.uint8)
+
+        M = np.array([[1., 0., -left], [0., 1., -upper], [0., 0., 1.]]) @ self.H
+        if not full_resolution or self.image_path is None:
+            return cv2.warpPerspective(self.page, M, (width, height))
+
+        scan = self.scan()
+        sx, sy = scan.shape[1] / self.width, scan.shape[0] / self.height
+        # Scan -> page -> reference patch -> patch at the scan resolution.
+        M = np.diag([sx, sy, 1.]) @ M @ np.diag([1. / sx, 1. / sy, 1.])
+        return cv2.warpPerspective(scan, M, (int(round(width * sx)), int(round(height * sy))))
+
+    def crop(self, box):
+        """Same as PIL Image.crop on the warped page, as an RGB PIL image."""
+        return Image.fromarray(cv2.cvtColor(self.warp_box(box), cv2.COLOR_GRAY2RGB))
+
+    def warp(self):
+        """Whole warped page as an RGB array, for display."""
+        return cv2.cvtColor(cv2.warpPerspective(self.page, self.H, self.size), cv2.COLOR_GRAY2RGB)
@@ -1,131 +1,389 @@
 import cv2
 import numpy as np
 import time
-import re
 import os
 import contextlib
 import io
-import pandas as pd
-from src.process.process import process_single_image, resise_image, display_images, choose_good_excel, append_df_to_excel, get_paths_dict
-from src.ocr.ocr_process import draw_boxes
+import asyncio
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import torch
+from src.process.process import process_images, load_page, display_images, choose_good_excel, get_page_paths
+from src.ocr.ocr_process import draw_boxes, concat_pages
+from src.ocr.blank_fields import BLANK_INK_THRESHOLD, blank_field_stats, blank_field_report
+from src.ocr.ocr_cache import OCRCache, OCR_CACHE_PATH, cache_report
+from src.ocr.ocr_trocr import TROCR_MODEL_NAME, TROCR_BATCH_SIZE, load_trocr_model
+from src.ocr.ocr_tesseract import set_tesseract_pool_size
 from src.process.train_process import load_models
+from src.process.retrieval import load_retrieval_index, shortlist_forms
+from src.process.model_store import ModelStore
+from src.process.pipeline import run_pipeline
+from src.process.result_sink import ExcelResultSink
+from src.process.progress import ProgressJournal, MAX_ATTEMPTS
+from src.process.manifest import iter_manifest
+from src.process.alignment import AlignedPage
 from src.superpoint.superpoint import initialize_superpoint
-from transformers import TrOCRProcessor, VisionEncoderDecoderModel
 
-def find_best_match(image_path, trained_models, superpoint):
-    max_matches = 0
-    best_matching_form = None
-    best_kp_ref = None
-    best_good_matches = None
+def stack_reference_models(trained_models):
+    """
+    Concatenate the reference descriptors of every form into one contiguous matrix.
 
+    :param trained_models: dict
+        Form name -> {'desc': 256xN descriptors, 'kp': 3xN keypoints}, as returned by load_models.
+    :return: dict
+        'names': form names, 'desc': N_total x 256 float32 descriptors,
+        'sq_norms': squared norms of the descriptors, 'kp': 2 x N_total float32 keypoints,
+        'offsets': F+1 array, the descriptors of form i are rows offsets[i]:offsets[i+1].
+    """
+    if isinstance(trained_models, ModelStore):
+        return trained_models.stacked_references()
+
+    names = list(trained_models.keys())
+    desc = [np.float32(trained_models[name]['desc']).T for name in names]
+    kp = [np.float32(trained_models[name]['kp'])[:2] for name in names]
+
+    offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([d.shape[0] for d in desc])
+
+    desc = np.ascontiguousarray(np.concatenate(desc, axis=0))
+    return {
+        'names': names,
+        'desc': desc,
+        'sq_norms': np.einsum('ij,ij->i', desc, desc),
+        'kp': np.ascontiguousarray(np.concatenate(kp, axis=1)),
+        'offsets': offsets,
+    }
+
+def select_reference_forms(references, names):
+    """Restrict stacked references, as returned by stack_reference_models, to some forms."""
+    ids = [references['names'].index(name) for name in names]
+    offsets = references['offsets']
+    rows = np.concatenate([np.arange(offsets[i], offsets[i + 1]) for i in ids])
+
+    new_offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+    new_offsets[1:] = np.cumsum([offsets[i + 1] - offsets[i] for i in ids])
+    return {
+        'names': [references['names'][i] for i in ids],
+        'desc': references['desc'][rows],
+        'sq_norms': references['sq_norms'][rows],
+        'kp': references['kp'][:, rows],
+        'offsets': new_offsets,
+    }
+
+def match_reference_forms(descriptors, references, ratio=0.70, chunk_size=2048):
+    """
+    Match the descriptors of a page against every reference form at once and apply
+    the ratio test form by form.
+
+    :param descriptors: 256xN descriptors of the page.
+    :param references: dict returned by stack_reference_models.
+    :return: list
+        One (query_idx, train_idx) pair of index arrays per form, train_idx being
+        relative to the form.
+    """
+    query = np.ascontiguousarray(np.float32(descriptors).T)
+    offsets = references['offsets']
+    nb_forms = len(references['names'])
+    query_idx = [[] for _ in range(nb_forms)]
+    train_idx = [[] for _ in range(nb_forms)]
+
+    for start in range(0, query.shape[0], chunk_size):
+        chunk = query[start:start + chunk_size]
+        # Squared L2 distances to every reference descriptor with one matrix product.
+        dist = references['sq_norms'][np.newaxis, :] - 2. * (chunk @ references['desc'].T)
+        dist += np.einsum('ij,ij->i', chunk, chunk)[:, np.newaxis]
+        np.maximum(dist, 0., out=dist)
+
+        for i in range(nb_forms):
+            form_dist = dist[:, offsets[i]:offsets[i + 1]]
+            if form_dist.shape[1] < 2:
+                continue
+            two_nearest = np.partition(form_dist, 1, axis=1)
+            # m.distance < ratio * n.distance on squared distances.
+            good = two_nearest[:, 0] < (ratio ** 2) * two_nearest[:, 1]
+            rows = np.nonzero(good)[0]
+            query_idx[i].append(rows + start)
+            train_idx[i].append(np.argmin(form_dist[rows], axis=1))
+
+    return [(np.concatenate(q) if q else np.zeros(0, dtype=np.int64),
+             np.concatenate(t) if t else np.zeros(0, dtype=np.int64))
+            for q, t in zip(query_idx, train_idx)]
+
+RETRIEVAL_TOP_K = 8
+
+def find_best_match(image_path, trained_models, superpoint, features=None, references=None, retrieval_index=None, top_k=RETRIEVAL_TOP_K, page=None, full_resolution=False):
     print(f"==> Finding best matching form for image: {image_path}...")
     start_time = time.time()
 
-    keypoints, descriptors = process_single_image(image_path, superpoint, display=False)
-    descriptors = np.ascontiguousarray(descriptors)
+    if page is None:
+        page = load_page(image_path)
 
-    bf = cv2.BFMatcher(cv2.NORM_L2, crossCheck=False)
+    if features is None:
+        keypoints, descriptors = process_images([page], superpoint)[0]
+    else:
+        keypoints, descriptors = features
 
+    if references is None:
+        references = stack_reference_models(trained_models)
 
-    for form_name, model_data in trained_models.items():
-        desc_ref = model_data['desc']
-        kp_ref = model_data['kp']
+    # Only the forms shortlisted by the inverted index go to full matching.
+    if retrieval_index is not None and len(references['names']) > top_k:
+        shortlist = shortlist_forms(descriptors, retrieval_index, top_k)
+        print(f"Shortlisted forms: {shortlist}")
+        references = select_reference_forms(references, shortlist)
 
-        matches = bf.knnMatch(np.float32(descriptors).T, np.float32(desc_ref).T, k=2)
-        good_matches = [m for m, n in matches if m.distance < 0.70 * n.distance]
+    matches = match_reference_forms(descriptors, references)
+    nb_good_matches = np.array([len(query_idx) for query_idx, _ in matches])
+    for form_name, count in zip(references['names'], nb_good_matches):
+        print(f"{count} good matches found for form {form_name}.")
+
+    best = int(np.argmax(nb_good_matches))
+    best_matching_form = references['names'][best]
+    query_idx, train_idx = matches[best]
+    best_kp_ref = references['kp'][:, references['offsets'][best]:references['offsets'][best + 1]]
+
+    src_pts = np.float32(keypoints[:2, query_idx].T).reshape(-1, 1, 2)
+    dst_pts = np.float32(best_kp_ref[:, train_idx].T).reshape(-1, 1, 2)
 
-        nb_good_matches = len(good_matches)
-        print(f"{nb_good_matches} good matches found for form {form_name}.")
-        
-        if nb_good_matches > max_matches:
-            max_matches = nb_good_matches
-            best_matching_form = form_name
-            best_good_matches = good_matches
-            best_kp_ref = kp_ref
-
-    print(keypoints.shape)
-    print(best_kp_ref.shape)
-    
-    src_pts = np.float32([[keypoints[0, m.queryIdx], keypoints[1, m.queryIdx]] for m in best_good_matches]).reshape(-1, 1, 2)
-    dst_pts = np.float32([[best_kp_ref[0, m.trainIdx], best_kp_ref[1, m.trainIdx]] for m in best_good_matches]).reshape(-1, 1, 2)
-            
     H, mask = cv2.findHomography(src_pts, dst_pts, cv2.RANSAC, 5.0)
     
-    image = cv2.imread(image_path, 0)
-    image = resise_image(image)
+    # The fields are warped one by one when they are cropped.
+    aligned_page = AlignedPage(page, H, image_path, full_resolution=full_resolution)
 
-    print(best_kp_ref.shape)
+    print(f"==> Best matching form found. Time taken: {time.time() - start_time:.2f} seconds.")
+    return best_matching_form, keypoints, aligned_page
 
-    height, width = image.shape
-    transformed_image = cv2.warpPerspective(image, H, (width, height))
+class InferenceSession(object):
+    """ Keeps SuperPoint, the reference descriptors/keypoints and the optional
+    TrOCR model loaded so that they are reused across pages.
+    With full_resolution, the fields are cropped from the original scans.
+    With mosaic, the Google OCR fields of a page are sent as a few composite images.
+    trocr_backend is one of TROCR_BACKENDS ('eager', 'int8' or 'onnx'), trocr_batch_size the crops per generate call.
+    Fields with less new ink than blank_threshold are left empty without OCR (None: no filter).
+    The texts are kept in the OCR cache of ocr_cache (None: no cache). """
+    def __init__(self, path_models='./data/forms_ref', ocr=None, full_resolution=False, mosaic=False, trocr_backend='eager',
+                 blank_threshold=BLANK_INK_THRESHOLD, ocr_cache=OCR_CACHE_PATH, trocr_batch_size=TROCR_BATCH_SIZE):
+        self.path_models = path_models
+        self.full_resolution = full_resolution
+        self.mosaic = mosaic
+        self.trocr_backend = trocr_backend
+        self.trocr_batch_size = trocr_batch_size
+        self.blank_threshold = blank_threshold
+        self.cache = OCRCache(ocr_cache) if ocr_cache else None
+        self.loaded_trocr_backend = None
+        self.superpoint = initialize_superpoint()
+        self.trained_models = load_models(path_models)
+        self.references = stack_reference_models(self.trained_models)
+        self.retrieval_index = load_retrieval_index(path_models)
+        if self.retrieval_index is not None and set(self.retrieval_index['names']) != set(self.references['names']):
+            print("Warning: the retrieval index does not match the reference forms, run the preprocess again to rebuild it.")
+            self.retrieval_index = None
+        self.model = None
+        self.processor = None
+        if ocr == 'trocr':
+            self.load_trocr()
 
-    img_rgb = cv2.cvtColor(transformed_image, cv2.COLOR_BGR2RGB)
+    def load_trocr(self):
+        """Load the TrOCR model and processor once, again if trocr_backend changed."""
+        if self.model is None or self.loaded_trocr_backend != self.trocr_backend:
+            self.model, self.processor = load_trocr_model(TROCR_MODEL_NAME, self.trocr_backend)
+            self.loaded_trocr_backend = self.trocr_backend
+        return self.model, self.processor
 
-    print(f"==> Best matching form found. Time taken: {time.time() - start_time:.2f} seconds.")
-    return best_matching_form, keypoints, img_rgb
+    def engine_config(self, ocr):
+        """Settings of the OCR engine that change its results, part of the OCR cache keys."""
+        if ocr == 'trocr':
+            return {'model': TROCR_MODEL_NAME, 'backend': self.trocr_backend}
+        return {}
 
-def inference(test_image_path, path_models):
-    superpoint = initialize_superpoint()
-    trained_models = load_models(path_models)
-    print("==> Starting inference phase...")
-    start_time = time.time()
+    def classify_and_align(self, image_path):
+        """Find the reference form of an image and align the image on it."""
+        return self.classify_and_align_batch([image_path])[0]
 
-    best_matching_form, keypoints, img = find_best_match(test_image_path, trained_models, superpoint)
+    def classify_and_align_batch(self, image_paths, batch_size=2):
+        """Same as classify_and_align for several pages, SuperPoint being run
+        on batch_size pages at once. Each file is decoded once."""
+        print("==> Starting inference phase...")
+        start_time = time.time()
 
-    print(f"The best matching form for the test image is {best_matching_form}.")
-    print(f"==> Inference phase completed. Total time taken: {time.time() - start_time:.2f} seconds.")  
+        pages = [load_page(image_path) for image_path in image_paths]
+        features = process_images(pages, self.superpoint, batch_size=batch_size)
 
-    return best_matching_form, keypoints, img
+        results = []
+        for image_path, page, image_features in zip(image_paths, pages, features):
+            best_matching_form, keypoints, img = self.align(image_path, image_features, page)
+            print(f"The best matching form for the test image is {best_matching_form}.")
+            results.append((best_matching_form, keypoints, img))
 
-def run_all(path, path_model, ocr, nb_forms=20, nb_ocr=5, verbose=False):
-    counter = 0
+        print(f"==> Inference phase completed. Total time taken: {time.time() - start_time:.2f} seconds.")
 
-    dict_spi_path = get_paths_dict(path)
+        return results
 
-    df = None
+    def align(self, image_path, features, page=None):
+        """Find the reference form of an image from its SuperPoint features and align the image on it."""
+        return find_best_match(image_path, self.trained_models, self.superpoint, features=features,
+                               references=self.references, retrieval_index=self.retrieval_index, page=page,
+                               full_resolution=self.full_resolution)
+
+    def extract_fields(self, ocr, image, match_form, nb_ocr=0):
+        """Run the OCR engine on the labelled fields of an aligned image."""
+        if ocr == 'trocr':
+            self.load_trocr()
+        return draw_boxes(ocr, image, match_form, nb_ocr, model=self.model, processor=self.processor, mosaic=self.mosaic,
+                          blank_threshold=self.blank_threshold, cache=self.cache, engine_config=self.engine_config(ocr),
+                          batch_size=self.trocr_batch_size, path_models=self.path_models)
+
+def inference(test_image_path, path_models, session=None):
+    if session is None:
+        session = InferenceSession(path_models)
+
+    return session.classify_and_align(test_image_path)
+
+def process_spi(session, spi, path_recto, ocr, nb_ocr, verbose=False):
+    """Classify, align and OCR the recto and verso of one SPI."""
+    new_recto, new_verso = get_page_paths(path_recto)
+
+    print(spi)
+    print(f'Recto: {new_recto} | File exist: {os.path.exists(new_recto)}')
+    print(f'Recto: {new_verso} | File exist: {os.path.exists(new_verso)}')
+
+    temp_stdout = io.StringIO()
+    with contextlib.redirect_stdout(temp_stdout):
+        (match_form_R, keypoints_R, image_R), (match_form_V, keypoints_V, image_V) = session.classify_and_align_batch([new_recto, new_verso])
+
+    if 'recto' not in match_form_R or 'verso' not in match_form_V:
+        raise ValueError("Error: Either 'recto' or 'verso' not found.")
+    else:
+        print('Good superpoint')        
+        
+    print(match_form_R)
+
+    img_R, strings_R, df_R = session.extract_fields(ocr, image_R, match_form_R, nb_ocr)
+    img_V, strings_V, df_V = session.extract_fields(ocr, image_V, match_form_V, nb_ocr)
+
+    if verbose:
+        display_images(image_R.warp(), image_V.warp(), title1=match_form_R, title2=match_form_V)
 
-    model = None
-    processor = None
-    if ocr == 'trocr':
-        processor = TrOCRProcessor.from_pretrained("microsoft/trocr-small-handwritten")
-        model = VisionEncoderDecoderModel.from_pretrained("microsoft/trocr-small-handwritten")
+    df_concatenated = concat_pages([df_R, df_V])
+    sheet_name = choose_good_excel(match_form_R)
 
-    for spi, path_recto in dict_spi_path.items():
-        if counter >= nb_forms:
-            break
-        print(f"=====> {counter}/{nb_forms}")
-        path_verso = re.sub(r'_R\.jpg$', '_V.jpg', path_recto)
+    return sheet_name, df_concatenated
 
-        print(spi)
-        new_recto = os.path.join('../../Data/POC/', path_recto)
-        new_verso = os.path.join('../../Data/POC/', path_verso)
-        print(f'Recto: {path_recto} | File exist: {os.path.exists(new_recto)}')
-        print(f'Recto: {path_verso} | File exist: {os.path.exists(new_verso)}')
+# Session of a worker process of run_all, loaded once by _init_worker.
+_worker_session = None
 
-        temp_stdout = io.StringIO()
-        with contextlib.redirect_stdout(temp_stdout):
-            match_form_R, keypoints_R, image_R = inference(test_image_path=new_recto, path_models=path_model)
-            match_form_V, keypoints_V, image_V = inference(test_image_path=new_verso, path_models=path_model)
+def _init_worker(path_model, ocr, nb_threads, mosaic=False, trocr_backend='eager', blank_threshold=BLANK_INK_THRESHOLD,
+                 ocr_cache=OCR_CACHE_PATH, trocr_batch_size=TROCR_BATCH_SIZE):
+    global _worker_session
+    torch.set_num_threads(nb_threads)
+    # As torch, the Tesseract engines of a worker share its part of the cores.
+    set_tesseract_pool_size(nb_threads)
+    _worker_session = InferenceSession(path_model, ocr, mosaic=mosaic, trocr_backend=trocr_backend, blank_threshold=blank_threshold,
+                                       ocr_cache=ocr_cache, trocr_batch_size=trocr_batch_size)
+
+def _process_spi_worker(task):
+    spi, path_recto, ocr, nb_ocr = task
+    start_time = time.time()
+    stats = dict(blank_field_stats)
+    cache = _worker_session.cache
+    cache_counts = (cache.hits, cache.misses) if cache is not None else (0, 0)
+    sheet_name, df_concatenated, error = None, None, None
+    try:
+        sheet_name, df_concatenated = process_spi(_worker_session, spi, path_recto, ocr, nb_ocr)
+    except Exception as exception:
+        # Returned with its duration, as the serial path records it.
+        error = exception
+    # The counts of this SPI go back with its row, blank_field_stats being per process.
+    stats = {key: blank_field_stats[key] - count for key, count in stats.items()}
+    if cache is not None:
+        cache_counts = (cache.hits - cache_counts[0], cache.misses - cache_counts[1])
+    return sheet_name, df_concatenated, error, time.time() - start_time, stats, cache_counts
+
+def run_all(path, path_model, ocr, nb_forms=20, nb_ocr=5, verbose=False, session=None, workers=1, pipeline=False, mosaic=False, trocr_backend='eager',
+            blank_threshold=BLANK_INK_THRESHOLD, ocr_cache=OCR_CACHE_PATH, resume=False, max_attempts=MAX_ATTEMPTS, trocr_batch_size=TROCR_BATCH_SIZE):
+    """
+    Process the first nb_forms SPIs of the manifest and write their rows in Acquisition_{ocr}.xlsx.
+
+    The status of each SPI is recorded in Acquisition_{ocr}.progress.jsonl: a failing SPI is
+    recorded and the run goes on. With resume, the SPIs done by the previous runs are skipped
+    and the failed ones retried, up to max_attempts attempts each.
+    """
+    # Only the first nb_forms rows of the manifest are read.
+    tasks = [(spi, path_recto, ocr, nb_ocr) for spi, path_recto, _ in itertools.islice(iter_manifest(path), nb_forms)]
+
+    df = None
+    # Les lignes sont écrites dans le classeur en une fois, à la fin.
+    excel_path = f'./data/excel/Acquisition_{ocr}.xlsx'
+    progress = ProgressJournal(f'./data/excel/Acquisition_{ocr}.progress.jsonl', resume, max_attempts)
+    tasks = progress.pending(tasks)
 
-        if 'recto' not in match_form_R or 'verso' not in match_form_V:
-            raise ValueError("Error: Either 'recto' or 'verso' not found.")
-        else:
-            print('Good superpoint')        
-            
-        print(match_form_R)
+    if workers > 1 and pipeline:
+        print("Warning: -pipeline is ignored with -workers, each worker processes its forms one after the other.")
 
-        img_R, strings_R, df_R = draw_boxes(ocr, image_R, match_form_R, nb_ocr, model=model, processor=processor)
-        img_V, strings_V, df_V = draw_boxes(ocr, image_V, match_form_V, nb_ocr, model=model, processor=processor)
+    if workers > 1:
+        # Each worker loads SuperPoint, the references and the OCR engine once, the
+        # results come back in manifest order and are written by this process only.
+        nb_threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(path_model, ocr, nb_threads, mosaic, trocr_backend, blank_threshold, ocr_cache, trocr_batch_size)) as executor, \
+             ExcelResultSink(excel_path) as sink, progress:
+            futures = [executor.submit(_process_spi_worker, task) for task in tasks]
+            cache_hits, cache_misses = 0, 0
+            for counter, ((spi, _, _, _), future) in enumerate(zip(tasks, futures)):
+                print(f"=====> {counter}/{len(tasks)}")
+                try:
+                    sheet_name, df_concatenated, error, duration, stats, (hits, misses) = future.result()
+                except BrokenProcessPool:
+                    # A worker failed to start (weights, models, OCR engine) or died: every pending
+                    # SPI would fail the same way and use up its -resume attempts, the run stops.
+                    print(f"Error: the worker pool broke at SPI {spi}, the SPIs not recorded yet are left for -resume.")
+                    raise
+                except Exception as pool_error:
+                    # The result could not be sent back, no duration measured.
+                    progress.failed(spi, 0, pool_error)
+                    continue
+                for key, count in stats.items():
+                    blank_field_stats[key] += count
+                cache_hits, cache_misses = cache_hits + hits, cache_misses + misses
+                if error is not None:
+                    progress.failed(spi, duration, error)
+                    continue
+                sink.append(df_concatenated, sheet_name, spi)
+                progress.done(spi, duration, excel_path, sheet_name, df_concatenated.attrs.get('blank_confidence'))
+                df = df_concatenated
+        print(f"==> {progress.report()}")
+        print(f"==> {blank_field_report()}")
+        if ocr_cache:
+            print(f"==> {cache_report(cache_hits, cache_misses)}")
+        return df
 
-        if verbose:
-            display_images(img_R, img_V, title1=match_form_R, title2=match_form_V)
+    if session is None:
+        session = InferenceSession(path_model, ocr, mosaic=mosaic, trocr_backend=trocr_backend, blank_threshold=blank_threshold,
+                                   ocr_cache=ocr_cache, trocr_batch_size=trocr_batch_size)
 
-        df_concatenated = pd.concat([df_R.reset_index(drop=True), df_V.reset_index(drop=True)], axis=1)
-        df = df_concatenated
+    with ExcelResultSink(excel_path) as sink, progress:
+        if pipeline:
+            df = asyncio.run(run_pipeline(tasks, session, ocr, nb_ocr, sink, progress))
+            print(f"==> {progress.report()}")
+            return df
 
-        sheet_name = choose_good_excel(match_form_R)
+        for counter, (spi, path_recto, _, _) in enumerate(tasks):
+            print(f"=====> {counter}/{len(tasks)}")
+            start_time = time.time()
+            try:
+                sheet_name, df_concatenated = process_spi(session, spi, path_recto, ocr, nb_ocr, verbose=verbose)
+            except Exception as error:
+                progress.failed(spi, time.time() - start_time, error)
+                continue
+            df = df_concatenated
 
-        append_df_to_excel(df_concatenated, excel_path=f'./data/excel/Acquisition_{ocr}.xlsx', sheet_name=sheet_name)
+            sink.append(df_concatenated, sheet_name, spi)
+            progress.done(spi, time.time() - start_time, excel_path, sheet_name, df_concatenated.attrs.get('blank_confidence'))
 
-        counter += 1
+    print(f"==> {progress.report()}")
+    print(f"==> {blank_field_report()}")
+    if session.cache is not None:
+        print(f"==> {session.cache.report()}")
     return df
\ No newline at end of file
@@ -0,0 +1,297 @@
+# read_ods_sheets
+# read_xlsx_sheets
+# as_text
+# parquet_cache
+# read_manifest
+# iter_manifest_chunks
+# iter_manifest
+
+import os
+import re
+import glob
+import time
+import hashlib
+import zipfile
+import itertools
+import xml.etree.ElementTree as ET
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+DEFAULT_MANIFEST_PATH = '../../Data/POC/table_correspondance_90pourcents.ods'
+# Spreadsheet manifests are converted once to parquet here, the file name holding the mtime of the source.
+MANIFEST_CACHE_PATH = './data/manifest_cache'
+MANIFEST_COLUMNS = ['Lot', 'Image', 'SPI']
+MANIFEST_CHUNK_SIZE = 10000
+
+# Texts read as empty cells by pd.read_excel (its default na_values).
+NA_TEXTS = {'', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+            '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'}
+
+_TABLE = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}'
+_OFFICE = '{urn:oasis:names:tc:opendocument:xmlns:office:1.0}'
+_TEXT = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+
+def _cell_text(element):
+    """Text of an ODS cell, built like pd.read_excel(engine='odf'): fragments joined
+    without separator, text:s expanded to spaces, annotations skipped."""
+    value = [(element.text or '').strip('\n')]
+    for child in element:
+        if child.tag == f'{_TEXT}s':
+            value.append(' ' * int(child.get(f'{_TEXT}c', 1)))
+        elif child.tag != f'{_OFFICE}annotation':
+            value.append(_cell_text(child))
+        value.append((child.tail or '').strip('\n'))
+    return ''.join(value)
+
+def _cell_value(cell):
+    """Value of an ODS cell, numbers converted like pd.read_excel(engine='odf') (integers as int)."""
+    value_type = cell.get(f'{_OFFICE}value-type')
+    if value_type is None:
+        return None
+    if value_type in ('float', 'percentage', 'currency'):
+        value = float(cell.get(f'{_OFFICE}value'))
+        return int(value) if value.is_integer() else value
+    if value_type == 'boolean':
+        return cell.get(f'{_OFFICE}boolean-value') == 'true'
+    if value_type == 'date':
+        return pd.Timestamp(cell.get(f'{_OFFICE}date-value'))
+    if value_type == 'time':
+        return pd.Timestamp(_cell_text(cell)).time()
+    return _cell_text(cell)
+
+def _sheet_frame(header, rows):
+    # As pd.read_excel, the sheet is as wide as its widest row.
+    width = max([len(header or [])] + [len(row) for row in rows])
+    data = [[None if isinstance(value, str) and value in NA_TEXTS else value for value in row] + [None] * (width - len(row))
+            for row in rows]
+    if header is None:
+        return pd.DataFrame(data)
+    header = header + [None] * (width - len(header))
+    columns = [name if name is not None else f"Unnamed: {i}" for i, name in enumerate(header)]
+    return pd.DataFrame(data, columns=columns)
+
+def read_ods_sheets(path, sheets=None, header=0):
+    """
+    Read sheets of an ODS file in one pass by streaming its content.xml, without
+    building the whole document in memory as odfpy does. Values are the ones of
+    pd.read_excel(engine='odf').
+
+    :param sheets: list of sheet names or indexes, every sheet if None.
+    :param header: 0 to use the first row as header, None for no header.
+    :return: dict sheet name or index (as requested) -> DataFrame
+    """
+    frames = {}
+    wanted = None if sheets is None else set(sheets)
+    key = None
+    table_index = -1
+    table = None
+
+    with zipfile.ZipFile(path) as archive, archive.open('content.xml') as content:
+        for event, element in ET.iterparse(content, events=('start', 'end')):
+            if element.tag == f'{_TABLE}table':
+                if event == 'start':
+                    table_index += 1
+                    table = element
+                    name = element.get(f'{_TABLE}name')
+                    key = name if wanted is None or name in wanted else table_index if table_index in wanted else None
+                    rows, cells, pending_cells, pending_rows = [], [], 0, 0
+                    first_row = header is not None
+                    head = None
+                elif key is not None:
+                    frames[key] = _sheet_frame(head, rows)
+                    if wanted is not None and len(frames) == len(wanted):
+                        break
+                continue
+            if key is None:
+                if event == 'end' and element.tag == f'{_TABLE}table-row' and table is not None:
+                    table.clear()
+                continue
+
+            if event == 'end' and element.tag in (f'{_TABLE}table-cell', f'{_TABLE}covered-table-cell'):
+                repeat = int(element.get(f'{_TABLE}number-columns-repeated', 1))
+                value = _cell_value(element)
+                if value is None or value == '':
+                    # Empty cells repeated up to the end of the sheet are never materialised.
+                    pending_cells += repeat
+                else:
+                    cells.extend([None] * pending_cells + [value] * repeat)
+                    pending_cells = 0
+
+            elif event == 'end' and element.tag == f'{_TABLE}table-row':
+                repeat = int(element.get(f'{_TABLE}number-rows-repeated', 1))
+                if first_row:
+                    head, first_row = cells, False
+                elif not cells:
+                    pending_rows += repeat
+                else:
+                    rows.extend([[]] * pending_rows + [cells] * repeat)
+                    pending_rows = 0
+                cells, pending_cells = [], 0
+                table.clear()
+
+    return frames
+
+def read_ods_sheet(path, sheet=0, header=0):
+    """One sheet of an ODS file, see read_ods_sheets."""
+    frames = read_ods_sheets(path, [sheet], header)
+    if sheet not in frames:
+        raise ValueError(f"Worksheet {sheet} not found in {path}.")
+    return frames[sheet]
+
+def _xlsx_rows(workbook, name, max_row=None):
+    """Rows of values of a sheet, up to its last used row, integers as int."""
+    worksheet = workbook[name]
+    if max_row is None:
+        # As pandas, the dimensions saved in the file are not trusted.
+        worksheet.reset_dimensions()
+    rows = []
+    for values in worksheet.iter_rows(max_row=max_row, values_only=True):
+        row = [int(value) if isinstance(value, float) and value.is_integer() else value for value in values]
+        while row and (row[-1] is None or row[-1] == ''):
+            row.pop()
+        rows.append(row)
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+def _is_formula(value):
+    return isinstance(value, str) and value.startswith('=')
+
+# Formulas made of a number only ('=3000', '= -657', '= 4000.'), computed by any spreadsheet application.
+_CONSTANT_FORMULA = re.compile(r'=\s*([+-]?\d+(?:\.\d*)?)\s*$')
+
+def _formula_value(formula):
+    """Value of a formula without cached value: the number of a constant formula, the formula as written otherwise."""
+    match = _CONSTANT_FORMULA.match(formula)
+    if match is None:
+        return formula
+    value = float(match.group(1))
+    return int(value) if value.is_integer() else value
+
+def read_xlsx_sheets(path, sheets, header=0, formulas=False):
+    """
+    Read sheets of an XLSX file with openpyxl in read-only mode. Values are the ones of
+    pd.read_excel(engine='openpyxl'): the values cached by the last application that
+    computed the formulas. Error values are read as their text ('#VALUE!'), as in the
+    ODS conversions of LibreOffice, where pandas reads them empty.
+
+    :param sheets: list of sheet names.
+    :param header: 0 to use the first row as header, None for no header.
+    :param formulas: True to fill the formulas without cached value, as in the workbooks
+        saved by openpyxl: a constant formula ('=3000') gives its number, the others are
+        read as written ('=X'). Otherwise these cells are empty. The formulas are read
+        first, the cached values then only on the rows used.
+    :return: dict sheet name -> DataFrame
+    """
+    frames = {}
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    formula_workbook = openpyxl.load_workbook(path, read_only=True, data_only=False) if formulas else None
+    try:
+        for name in sheets:
+            if formulas:
+                written_rows = _xlsx_rows(formula_workbook, name)
+                cached_rows = _xlsx_rows(workbook, name, max_row=max(len(written_rows), 1))
+                rows = [[(cached if cached is not None else _formula_value(written)) if _is_formula(written) else written
+                         for written, cached in itertools.zip_longest(written_row, cached_row[:len(written_row)])]
+                        for written_row, cached_row in itertools.zip_longest(written_rows, cached_rows[:len(written_rows)], fillvalue=[])]
+            else:
+                rows = _xlsx_rows(workbook, name)
+            head = rows.pop(0) if header is not None and rows else None
+            frames[name] = _sheet_frame(head, rows)
+    finally:
+        workbook.close()
+        if formula_workbook is not None:
+            formula_workbook.close()
+    return frames
+
+def as_text(df):
+    """Cells as str (None when empty): spreadsheet columns mix numbers and texts, and a common type for the joins."""
+    return df.apply(lambda column: column.map(lambda value: None if pd.isna(value) else str(value))).astype(object)
+
+def parquet_cache(path, cache_path, names, convert):
+    """
+    Parquet conversions of a spreadsheet, as text, one file per name (e.g. per sheet), named
+    after the path and the mtime of the spreadsheet: converted on first use and again when it changes.
+
+    :param convert: function path -> dict name -> DataFrame, called only when a conversion is missing.
+    :return: dict name -> parquet path
+    """
+    stat = os.stat(path)
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]
+    prefix = os.path.join(cache_path, f"{os.path.splitext(os.path.basename(path))[0]}-{key}")
+    paths = {name: f"{prefix}-{stat.st_mtime_ns}-{name}.parquet" for name in names}
+    if all(os.path.exists(parquet_path) for parquet_path in paths.values()):
+        return paths
+
+    start_time = time.time()
+    frames = convert(path)
+    os.makedirs(cache_path, exist_ok=True)
+    # Conversions of the previous versions of the file.
+    for old_path in glob.glob(f"{prefix}-*.parquet"):
+        os.remove(old_path)
+    for name, parquet_path in paths.items():
+        pq.write_table(pa.Table.from_pandas(as_text(frames[name].reset_index(drop=True)), preserve_index=False), f"{parquet_path}.tmp")
+        os.replace(f"{parquet_path}.tmp", parquet_path)
+    print(f"==> {path} converted to parquet in {cache_path}. Time taken: {time.time() - start_time:.2f} seconds.")
+    return paths
+
+def _read_manifest_sheet(path):
+    if path.endswith('.ods'):
+        return {'manifest': read_ods_sheet(path)}
+    if path.endswith('.xlsx'):
+        return {'manifest': pd.read_excel(path, engine='openpyxl')}
+    raise ValueError(f"Unsupported manifest format '{path}', expected .ods, .xlsx, .csv or .parquet.")
+
+def _manifest_parquet(path):
+    """Parquet file of a manifest, converting a spreadsheet (ODS/XLSX) on first use or when it changed."""
+    if path.endswith('.parquet'):
+        return path
+    return parquet_cache(path, MANIFEST_CACHE_PATH, ['manifest'], _read_manifest_sheet)['manifest']
+
+def read_manifest(path=None, columns=None):
+    """
+    Whole manifest as a DataFrame (cells as text), read from its parquet conversion.
+
+    :param columns: columns to read, all by default.
+    """
+    path = path or DEFAULT_MANIFEST_PATH
+    if path.endswith('.csv'):
+        return pd.read_csv(path, usecols=columns, dtype=str)
+    return pq.read_table(_manifest_parquet(path), columns=columns).to_pandas()
+
+def _batches(path, chunk_size):
+    """DataFrames of chunk_size rows of the Lot and Image columns, with the row number as index."""
+    if path.endswith('.csv'):
+        yield from pd.read_csv(path, usecols=['Lot', 'Image'], dtype=str, chunksize=chunk_size)
+        return
+
+    start = 0
+    for batch in pq.ParquetFile(_manifest_parquet(path)).iter_batches(batch_size=chunk_size, columns=['Lot', 'Image']):
+        df = batch.to_pandas()
+        df.index = pd.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
+
+def iter_manifest_chunks(path=None, chunk_size=MANIFEST_CHUNK_SIZE, shard_index=0, shard_count=1):
+    """
+    Read a manifest (ODS, XLSX, CSV or Parquet with 'Lot' and 'Image' columns) by chunks.
+
+    :param shard_index, shard_count: keep only the rows whose number modulo shard_count
+        is shard_index, to split a manifest between independent runs.
+    :return: generator
+        Lists of (spi, recto_path, verso_path), spi being the row number in the manifest
+        as in get_paths_dict. Rows without Lot or Image are skipped.
+    """
+    for df in _batches(path or DEFAULT_MANIFEST_PATH, chunk_size):
+        if shard_count > 1:
+            df = df[df.index % shard_count == shard_index]
+        df = df.dropna(subset=['Lot', 'Image'])
+
+        rectos = [os.path.join(lot, image) for lot, image in zip(df['Lot'].astype(str), df['Image'].astype(str))]
+        yield [(spi, recto, re.sub(r'_R\.jpg$', '_V.jpg', recto)) for spi, recto in zip(df.index.tolist(), rectos)]
+
+def iter_manifest(path=None, chunk_size=MANIFEST_CHUNK_SIZE, shard_index=0, shard_count=1):
+    """Records (spi, recto_path, verso_path) of a manifest, one at a time (see iter_manifest_chunks)."""
+    return itertools.chain.from_iterable(iter_manifest_chunks(path, chunk_size, shard_index, shard_count))
@@ -0,0 +1,154 @@
+# save_model_store
+# open_model_store
+# check_model_store
+
+import os
+import json
+import time
+from collections.abc import Mapping
+import numpy as np
+
+MODEL_STORE_FORMAT = 'pfee-model-store'
+MODEL_STORE_VERSION = 1
+MODEL_STORE_MANIFEST = 'model_store.json'
+MODEL_STORE_ARRAYS = {
+    # name: (file, number of columns)
+    'descriptors': ('model_store_descriptors.npy', 256),
+    'keypoints': ('model_store_keypoints.npy', 3),
+    'sq_norms': ('model_store_sq_norms.npy', None),
+}
+
+class ModelStore(Mapping):
+    """ Read-only view over the reference models of a folder, backed by memory-mapped
+    arrays. Behaves like the dict returned by load_models: store[form] gives
+    {'desc': 256xN descriptors, 'kp': 3xN keypoints}, as views on the mapped files. """
+    def __init__(self, folder_path, manifest, arrays):
+        self.folder_path = folder_path
+        self.manifest = manifest
+        self.arrays = arrays
+        self.forms = {form['name']: (form['offset'], form['offset'] + form['count'])
+                      for form in manifest['forms']}
+
+    def __getitem__(self, form_name):
+        start, end = self.forms[form_name]
+        return {'desc': self.arrays['descriptors'][start:end].T,
+                'kp': self.arrays['keypoints'][start:end].T}
+
+    def __iter__(self):
+        return iter(self.forms)
+
+    def __len__(self):
+        return len(self.forms)
+
+    def stacked_references(self):
+        """Same dict as stack_reference_models, without copying the mapped arrays."""
+        names = list(self.forms)
+        offsets = np.zeros(len(names) + 1, dtype=np.int64)
+        offsets[1:] = [self.forms[name][1] for name in names]
+        return {
+            'names': names,
+            'desc': self.arrays['descriptors'],
+            'sq_norms': self.arrays['sq_norms'],
+            'kp': self.arrays['keypoints'][:, :2].T,
+            'offsets': offsets,
+        }
+
+def _save_array(array, path):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+def save_model_store(trained_models, folder_path):
+    """
+    Save the reference models of every form as contiguous arrays plus a manifest.
+
+    :param trained_models: dict
+        Form name -> {'desc': 256xN descriptors, 'kp': 3xN keypoints}.
+    :param folder_path: str
+        Folder of the reference forms, the store is written at its root.
+    """
+    print(f"==> Saving model store in: {folder_path}...")
+    start_time = time.time()
+
+    forms = []
+    descriptors, keypoints = [], []
+    offset = 0
+    for form_name, model_data in trained_models.items():
+        desc = np.float32(model_data['desc']).T
+        kp = np.float32(model_data['kp']).T
+        if desc.shape[1] != MODEL_STORE_ARRAYS['descriptors'][1] or kp.shape[1] != MODEL_STORE_ARRAYS['keypoints'][1] or desc.shape[0] != kp.shape[0]:
+            raise ValueError(f"Unexpected descriptors {desc.T.shape} or keypoints {kp.T.shape} for form {form_name}.")
+
+        forms.append({'name': form_name, 'offset': offset, 'count': desc.shape[0]})
+        descriptors.append(desc)
+        keypoints.append(kp)
+        offset += desc.shape[0]
+
+    arrays = {
+        'descriptors': np.ascontiguousarray(np.concatenate(descriptors, axis=0)),
+        'keypoints': np.ascontiguousarray(np.concatenate(keypoints, axis=0)),
+    }
+    arrays['sq_norms'] = np.einsum('ij,ij->i', arrays['descriptors'], arrays['descriptors'])
+
+    manifest = {'format': MODEL_STORE_FORMAT, 'version': MODEL_STORE_VERSION, 'dtype': 'float32', 'forms': forms, 'arrays': {}}
+    for name, (file_name, _) in MODEL_STORE_ARRAYS.items():
+        _save_array(arrays[name], os.path.join(folder_path, file_name))
+        manifest['arrays'][name] = {'file': file_name, 'shape': list(arrays[name].shape)}
+
+    # The manifest is written last, a store without manifest is ignored.
+    manifest_path = os.path.join(folder_path, MODEL_STORE_MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    print(f"==> Model store saved. Time taken: {time.time() - start_time:.2f} seconds.")
+
+def open_model_store(folder_path, mmap_mode='r'):
+    """
+    Open the model store of a folder. The arrays are memory-mapped, so the pages are
+    only read when a form is used and are shared between processes by the OS.
+
+    :return: ModelStore or None
+        None if the folder has no model store.
+    :raises ValueError: if the store does not match its manifest.
+    """
+    manifest_path = os.path.join(folder_path, MODEL_STORE_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    if manifest.get('format') != MODEL_STORE_FORMAT or manifest.get('version') != MODEL_STORE_VERSION:
+        raise ValueError(f"Unsupported model store {manifest.get('format')} version {manifest.get('version')} in {folder_path}.")
+
+    total = sum(form['count'] for form in manifest['forms'])
+    arrays = {}
+    for name, (_, nb_columns) in MODEL_STORE_ARRAYS.items():
+        array = np.load(os.path.join(folder_path, manifest['arrays'][name]['file']), mmap_mode=mmap_mode)
+        expected_shape = (total, nb_columns) if nb_columns else (total,)
+        if array.dtype != np.float32 or array.shape != expected_shape or list(array.shape) != manifest['arrays'][name]['shape']:
+            raise ValueError(f"Corrupted model store in {folder_path}: {name} is {array.dtype} {array.shape}, expected float32 {expected_shape}.")
+        arrays[name] = array
+
+    return ModelStore(folder_path, manifest, arrays)
+
+def check_model_store(folder_path):
+    """
+    Verifies that the folder has a valid model store covering every form sub-folder.
+
+    :return: bool
+    """
+    try:
+        store = open_model_store(folder_path)
+    except (ValueError, OSError, KeyError) as e:
+        print(f"Invalid model store: {e}")
+        return False
+
+    if store is None:
+        return False
+
+    form_folders = {form_folder for form_folder in os.listdir(folder_path)
+                    if os.path.isdir(os.path.join(folder_path, form_folder))}
+    return form_folders == set(store.keys())
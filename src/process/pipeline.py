@@ -0,0 +1,168 @@
+# run_pipeline
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from src.process.process import load_page, superpoint_input, get_page_paths, choose_good_excel
+from src.ocr.engines import get_engine
+from src.ocr.ocr_process import prepare_fields, recognize_fields, page_dataframe, concat_pages, template_types
+from src.ocr.field_templates import load_field_template
+from src.ocr.blank_fields import blank_field_report
+
+# End of stream marker passed from one stage to the next.
+_END = object()
+# Forms whose OCR is in flight at once with a remote engine (Google Vision).
+REMOTE_OCR_CONCURRENCY = 4
+
+async def _stage(worker, inbox, outbox, on_error=None):
+    """Apply worker to every item of inbox, in order, and forward the results to outbox.
+    If on_error is given, the items whose worker raises are passed to it and dropped."""
+    while True:
+        item = await inbox.get()
+        if item is _END:
+            if outbox is not None:
+                await outbox.put(_END)
+            return
+        try:
+            result = await worker(item)
+        except Exception as error:
+            if on_error is None:
+                raise
+            on_error(item, error)
+            continue
+        if outbox is not None:
+            await outbox.put(result)
+
+async def run_pipeline(tasks, session, ocr, nb_ocr, result_sink, progress=None, queue_size=2, remote_ocr_concurrency=REMOTE_OCR_CONCURRENCY):
+    """
+    Process the SPIs of tasks with one asyncio stage per step:
+    load -> features -> match/warp -> crop -> OCR -> collect -> sink.
+
+    Stages are connected by bounded queues, so at most queue_size forms wait between
+    two stages. Every stage runs in a thread (SuperPoint, OpenCV, PyTorch, tesseract and
+    the Google Vision requests release the GIL), so the next forms are decoded and
+    aligned while the current one waits on OCR.
+
+    The OCR stage starts the OCR of a form and hands it to the collect stage, which
+    waits for the results in order. With a local engine (TrOCR, Tesseract), one form
+    is recognised at a time, the engine using the cores inside the call. With a remote
+    engine (OCREngine.remote), a semaphore lets the requests of up to
+    remote_ocr_concurrency forms wait on the network at once.
+
+    :param tasks: list of (spi, path_recto, ocr, nb_ocr), as built by run_all.
+    :param session: InferenceSession shared by every stage.
+    :param result_sink: ExcelResultSink receiving the row of each form.
+    :param progress: ProgressJournal or None. If given, a form failing at any stage is
+        recorded in it and the others go on; otherwise the first error stops the pipeline.
+    :param remote_ocr_concurrency: forms whose OCR is in flight at once with a remote engine.
+    :return: DataFrame of the last processed form.
+    """
+    loop = asyncio.get_running_loop()
+    io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='pipeline-io')
+    align_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pipeline-align')
+    # One batch call per form, the engines parallelise inside the call; the calls of
+    # several forms only overlap when they wait on a remote service.
+    ocr_concurrency = remote_ocr_concurrency if get_engine(ocr, mosaic=session.mosaic).remote else 1
+    ocr_executor = ThreadPoolExecutor(max_workers=ocr_concurrency, thread_name_prefix='pipeline-ocr')
+    ocr_slots = asyncio.Semaphore(ocr_concurrency)
+    if ocr == 'trocr':
+        session.load_trocr()
+    last_df = None
+
+    async def load(form):
+        print(f"=====> {form['counter']}/{len(tasks)} {form['spi']}")
+        form['start_time'] = time.time()
+        paths = get_page_paths(form.pop('path_recto'))
+        pages = await asyncio.gather(*[loop.run_in_executor(io_executor, load_page, path) for path in paths])
+        form.update({'paths': paths, 'scans': pages})
+        return form
+
+    def _features(form):
+        return session.superpoint.run_batch([superpoint_input(page) for page in form['scans']])
+
+    async def features(form):
+        form['features'] = await loop.run_in_executor(align_executor, _features, form)
+        return form
+
+    def _align(form):
+        return [session.align(path, (pts, desc), page)
+                for path, page, (pts, desc, _) in zip(form['paths'], form['scans'], form['features'])]
+
+    async def match(form):
+        (match_form_R, _, image_R), (match_form_V, _, image_V) = await loop.run_in_executor(align_executor, _align, form)
+        del form['features'], form['scans']
+        if 'recto' not in match_form_R or 'verso' not in match_form_V:
+            raise ValueError("Error: Either 'recto' or 'verso' not found.")
+        form['pages'] = [(match_form_R, image_R), (match_form_V, image_V)]
+        return form
+
+    def _crop(form):
+        # Checkboxes and blank fields are filled here, only the other fields go to the OCR stage.
+        templates = [load_field_template(match_form) for match_form, _ in form['pages']]
+        form['field_types'] = {label: kind for template in templates for label, kind in template_types(template).items()}
+        return [prepare_fields(image, match_form, nb_ocr, blank_threshold=session.blank_threshold, path_models=session.path_models, template=template)
+                for (match_form, image), template in zip(form['pages'], templates)]
+
+    async def crop(form):
+        form['fields'] = await loop.run_in_executor(align_executor, _crop, form)
+        form['sheet_name'] = choose_good_excel(form['pages'][0][0])
+        del form['pages']
+        return form
+
+    def _recognize(fields, types):
+        return recognize_fields(ocr, fields, session.model, session.processor, session.mosaic,
+                                cache=session.cache, engine_config=session.engine_config(ocr), batch_size=session.trocr_batch_size,
+                                field_types=types)
+
+    async def extract(form):
+        # The fields of the recto and the verso are recognised in the same batch call.
+        text_fields = [field for _, _, _, page_fields in form['fields'] for field in page_fields]
+        # Waits while ocr_concurrency forms are already in flight.
+        await ocr_slots.acquire()
+        form['texts'] = loop.run_in_executor(ocr_executor, _recognize, text_fields, form.pop('field_types'))
+        form['texts'].add_done_callback(lambda _: ocr_slots.release())
+        return form
+
+    async def collect(form):
+        pages = form.pop('fields')
+        texts = iter(await form.pop('texts'))
+
+        dfs = [page_dataframe(fields, values, confidences, page_fields, [next(texts) for _ in page_fields])
+               for fields, values, confidences, page_fields in pages]
+        form['df'] = concat_pages(dfs)
+        return form
+
+    async def sink(form):
+        nonlocal last_df
+        await loop.run_in_executor(io_executor, result_sink.append, form['df'], form['sheet_name'], form['spi'])
+        last_df = form['df']
+        if progress is not None:
+            progress.done(form['spi'], time.time() - form['start_time'], result_sink.excel_path, form['sheet_name'],
+                          form['df'].attrs.get('blank_confidence'))
+        print(f"==> SPI {form['spi']} done. Time taken: {time.time() - form['start_time']:.2f} seconds.")
+
+    def failed(form, error):
+        progress.failed(form['spi'], time.time() - form.get('start_time', time.time()), error)
+
+    stages = [load, features, match, crop, extract, collect, sink]
+    # The queue of collect holds the forms whose OCR is in flight.
+    queues = [asyncio.Queue(maxsize=max(queue_size, ocr_concurrency) if stage is collect else queue_size) for stage in stages]
+
+    async def feed():
+        for counter, (spi, path_recto, _, _) in enumerate(tasks):
+            await queues[0].put({'counter': counter, 'spi': spi, 'path_recto': path_recto})
+        await queues[0].put(_END)
+
+    try:
+        await asyncio.gather(feed(), *[_stage(stage, queues[i], queues[i + 1] if i + 1 < len(stages) else None,
+                                              failed if progress is not None else None)
+                                       for i, stage in enumerate(stages)])
+    finally:
+        for executor in (io_executor, align_executor, ocr_executor):
+            executor.shutdown(wait=False)
+
+    print(f"==> {blank_field_report()}")
+    if session.cache is not None:
+        print(f"==> {session.cache.report()}")
+
+    return last_df
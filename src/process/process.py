@@ -1,35 +1,57 @@
 # resize image
+# load_page
 # process_single_image
 # process_form_folder
 
 import cv2
+import re
 import time
 import numpy as np
 import matplotlib.pyplot as plt
 import os
-import pandas as pd
-from openpyxl import load_workbook
+from src.process.manifest import iter_manifest
+
+# Size (width, height) of the pages and of the reference forms for the alignment.
+ALIGNMENT_SIZE = (1970, 1436)
 
 def resise_image(image, scale_percent=40):
     """Resize an image to a given scale."""
     #width = int(image.shape[1] * scale_percent / 100)
     #height = int(image.shape[0] * scale_percent / 100)
 
-    width = 1970
-    height = 1436
+    width, height = ALIGNMENT_SIZE
     dim = (width, height)
     resized_image = cv2.resize(image, dim)
     return resized_image
 
+def load_page(image_path, resize=40):
+    """
+    Decode an image once at the alignment resolution, as a uint8 grayscale image.
+
+    JPEG scans are decoded at half resolution directly in the DCT domain
+    (IMREAD_REDUCED_GRAYSCALE_2), which is still larger than the alignment resolution.
+    The same buffer is used for SuperPoint and for the warp.
+    """
+    image = cv2.imread(image_path, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if image is None:
+        raise FileNotFoundError(f"Error: The image '{image_path}' can not be read.")
+
+    width, height = ALIGNMENT_SIZE
+    if image.shape[1] < width or image.shape[0] < height:
+        # Small scan, decode it at full resolution rather than upscaling a reduced one.
+        image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
+    return resise_image(image, resize)
+
+def superpoint_input(page):
+    """Convert a uint8 page to the float32 image in range [0,1] expected by SuperPoint."""
+    return np.float32(page) / 255.0
+
 def process_single_image(image_path, superpoint, display=False, resize=40):
     """Process an individual image to extract keypoints and descriptors."""
 
     print(f"==> Processing image: {image_path}...")
     start_time = time.time()
-    image = cv2.imread(image_path, 0)
-    image = np.float32(image) / 255.0
-    
-    resised_image = resise_image(image, resize)
+    resised_image = superpoint_input(load_page(image_path, resize))
     keypoints, descriptors, _ = superpoint.run(resised_image)
         
     if display:
@@ -41,6 +63,22 @@ def process_single_image(image_path, superpoint, display=False, resize=40):
     print(f"==> Finished processing image. Time taken: {time.time() - start_time:.2f} seconds.")
     return keypoints, descriptors
 
+def process_images(pages, superpoint, batch_size=2):
+    """Process several pages, as returned by load_page, with batched SuperPoint forward passes."""
+
+    print(f"==> Processing {len(pages)} images...")
+    start_time = time.time()
+    features = []
+
+    for i in range(0, len(pages), batch_size):
+        images = [superpoint_input(page) for page in pages[i:i + batch_size]]
+
+        for keypoints, descriptors, _ in superpoint.run_batch(images):
+            features.append((keypoints, descriptors))
+
+    print(f"==> Finished processing images. Time taken: {time.time() - start_time:.2f} seconds.")
+    return features
+
 def process_form_folder(form_folder_path, superpoint):
     """Process all images within a folder."""
 
@@ -75,6 +113,11 @@ def process_form_folder(form_folder_path, superpoint):
     
     return keypoints_list, descriptors_list, desc_ref, kp_ref
 
+def get_page_paths(path_recto, base_path='../../Data/POC/'):
+    """Return the recto and verso paths of a form from the recto path of the manifest."""
+    path_verso = re.sub(r'_R\.jpg$', '_V.jpg', path_recto)
+    return os.path.join(base_path, path_recto), os.path.join(base_path, path_verso)
+
 def choose_good_excel(match_form):
     if '2042_K_' in match_form:
         return '2042K'
@@ -106,93 +149,13 @@ def display_images(img1, img2, title1='Image 1', title2='Image 2'):
     plt.tight_layout()
     plt.show()
 
-def append_df_to_excel(df, excel_path, sheet_name):
-    workbook = load_workbook(excel_path)
-    sheet = workbook[sheet_name]
-    
-    max_row_by_col = {}
-    for column in df:
-        max_row_by_col[column] = sheet.max_row
-    
-    # Obtenir les valeurs à ajouter depuis le DataFrame
-    for column in df:
-        # Obtenir la première rangée vide pour la colonne
-        row = max_row_by_col[column] + 1
-        # Obtenir la valeur à ajouter - on suppose qu'il y a une seule valeur par colonne dans le DataFrame
-        value = df.at[0, column]  # Obtient la valeur de la première rangée pour la colonne actuelle
-        if pd.notna(value):  # Vérifier si la valeur n'est pas NaN
-            # Mettre à jour la cellule dans le fichier Excel
-            sheet[f"{column}{row}"] = value
-    
-    # Sauvegarder le classeur
-    workbook.save(excel_path)
-
-def create_paths(df):
-    """
-    Creates a dictionary where each key is a concatenated path from 'Lot' and 'Image' columns
-    and each value is the corresponding 'SPI' value, filtering out rows where 'SPI' is '0000000000000'.
-    
-    :param df: DataFrame
-        Input DataFrame to be processed.
-    :return: dict
-        A dictionary containing paths as keys and 'SPI' values as values.
-    """
-    paths_dict = {}
-    try:
-        # Iterating over rows in the DataFrame
-        for index, row in df.iterrows():
-                path = os.path.join(str(row['Lot']), str(row['Image']))
-                paths_dict[index] = path
-
-                
-    except KeyError as e:
-        print(f"Error: Column not found in the DataFrame: {e}")
-    except Exception as e:
-        print(f"An error occurred while processing the DataFrame: {e}")
-        
-    return paths_dict
-
-def load_file_into_dataframe(file_path):
-    """
-    Load an Excel or ODS file into a DataFrame.
-    
-    :param file_path: str
-        Path to the file to be loaded.
-    :return: DataFrame or None
-        Returns a DataFrame if successful, otherwise None.
-    """
-    try:
-        # Loading Excel file
-        if file_path.endswith('.xlsx'):
-            df = pd.read_excel(file_path, engine='openpyxl')
-        # Loading ODS file
-        elif file_path.endswith('.ods'):
-            df = pd.read_excel(file_path, engine='odf')
-        else:
-            print("Error: Unsupported file format. Please provide an .ods or .xlsx file.")
-            return None
-        
-        return df
-    
-    except FileNotFoundError:
-        print(f"Error: The file '{file_path}' does not exist.")
-    except PermissionError:
-        print(f"Error: Permission denied to access the file '{file_path}'.")
-    except Exception as e:
-        print(f"An error occurred while loading the file: {e}")
-
 def get_paths_dict(path=None, verbose=False):
-
-    if path is None:
-        path = '../../Data/POC/table_correspondance_90pourcents.ods'
-
-    df = load_file_into_dataframe(path)
-
-    paths_dict = create_paths(df)
+    """Dict row number -> recto path of the manifest, read with iter_manifest."""
+    paths_dict = {spi: path_recto for spi, path_recto, _ in iter_manifest(path)}
 
     if verbose:
         print(len(paths_dict))
         for spi, path in paths_dict.items():
             print(f"SPI: {spi}, Path: {path}")
     
-    return paths_dict
\ No newline at end of file
+    return paths_dict
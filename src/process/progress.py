@@ -0,0 +1,83 @@
+# ProgressJournal
+
+import os
+import json
+import time
+import traceback
+from collections import Counter
+
+# Attempts of an SPI, over every run, before it is no longer retried by -resume.
+MAX_ATTEMPTS = 3
+
+class ProgressJournal(object):
+    """ Status of each SPI of an acquisition run, one json line appended per
+    attempt: {'spi', 'status' ('done' or 'failed'), 'attempt', 'duration', 'time',
+    'excel_path', 'sheet' and 'blank_confidence' (label -> confidence of the blank
+    fields) of the row, or 'error'}.
+
+    Without resume the journal of the previous run is cleared. With resume, the
+    SPIs already done are skipped and the failed ones are retried while they have
+    been attempted less than max_attempts times. """
+    def __init__(self, path, resume=False, max_attempts=MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.status = {}
+        self.attempts = Counter()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        if resume and os.path.exists(path):
+            with open(path, 'r') as journal:
+                for line in journal:
+                    if not line.strip():
+                        continue
+                    entry = json.loads(line)
+                    self.status[entry['spi']] = entry['status']
+                    self.attempts[entry['spi']] += 1
+        self._journal = open(path, 'a' if resume else 'w')
+        self.done_count, self.failed_count = 0, 0
+
+    def pending(self, tasks):
+        """
+        Tasks of run_all still to process.
+
+        :param tasks: list of (spi, path_recto, ocr, nb_ocr).
+        """
+        done = [task for task in tasks if self.status.get(str(task[0])) == 'done']
+        given_up = [task for task in tasks if self.status.get(str(task[0])) == 'failed' and self.attempts[str(task[0])] >= self.max_attempts]
+        if done or given_up:
+            print(f"==> Resume: {len(done)} SPIs already done, {len(given_up)} SPIs failed {self.max_attempts} times skipped.")
+        skipped = {str(task[0]) for task in done + given_up}
+        return [task for task in tasks if str(task[0]) not in skipped]
+
+    def _write(self, spi, status, duration, **fields):
+        spi = str(spi)
+        self.status[spi] = status
+        self.attempts[spi] += 1
+        entry = {'spi': spi, 'status': status, 'attempt': self.attempts[spi], 'duration': round(duration, 3), 'time': time.time(), **fields}
+        self._journal.write(json.dumps(entry) + '\n')
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+    def done(self, spi, duration, excel_path, sheet_name, blank_confidence=None):
+        """Record an SPI whose row has been handed to the result sink, with the confidence of its blank fields."""
+        self._write(spi, 'done', duration, excel_path=excel_path, sheet=sheet_name, blank_confidence=blank_confidence or {})
+        self.done_count += 1
+
+    def failed(self, spi, duration, error):
+        """Record an SPI that raised error, the run goes on with the next one."""
+        print(f"==> SPI {spi} failed (attempt {self.attempts[str(spi)] + 1}/{self.max_attempts}): {error!r}")
+        self._write(spi, 'failed', duration, error=''.join(traceback.format_exception_only(type(error), error)).strip())
+        self.failed_count += 1
+
+    def report(self):
+        return f"{self.done_count} SPIs done, {self.failed_count} failed (details in {self.path})."
+
+    def close(self):
+        self._journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,91 @@
+# ExcelResultSink
+
+import os
+import json
+import time
+import pandas as pd
+from openpyxl import load_workbook
+
+class ExcelResultSink(object):
+    """ Rows of the acquisition workbook, written in bulk instead of one workbook
+    load/save per SPI.
+
+    Each row is appended to a journal (one json line per SPI, fsynced) as soon as it is
+    received, and the workbook is rendered from the rows at flush(): once at the end
+    of the run, every flush_every rows, or on demand. Each row is written under
+    the last used row of its sheet, empty values left out.
+
+    Rows left in the journal by a killed run are rendered at the next flush. """
+    def __init__(self, excel_path, journal_path=None, flush_every=None):
+        self.excel_path = excel_path
+        self.journal_path = journal_path or f"{os.path.splitext(excel_path)[0]}.journal.jsonl"
+        self.flush_every = flush_every
+        self.rows = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'r') as journal:
+                self.rows = [json.loads(line) for line in journal if line.strip()]
+            if self.rows:
+                print(f"==> {len(self.rows)} rows of a previous run found in {self.journal_path}.")
+        self._journal = open(self.journal_path, 'a')
+
+    @staticmethod
+    def _json_value(value):
+        # numpy scalars of the DataFrames
+        return value.item() if hasattr(value, 'item') else str(value)
+
+    def append(self, df, sheet_name, spi=None):
+        """Add the first row of df to sheet_name, columns being the Excel column letters."""
+        values = {}
+        for column in df:
+            value = df.at[0, column]
+            if pd.notna(value):
+                values[column] = value
+        row = {'spi': spi, 'sheet': sheet_name, 'values': values}
+
+        self._journal.write(json.dumps(row, default=self._json_value) + '\n')
+        # On disk before the progress journal records the SPI as done, -resume skips it.
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self.rows.append(row)
+
+        if self.flush_every and len(self.rows) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Render the buffered rows into the workbook with one load and one save, then empty the journal."""
+        if not self.rows:
+            return
+        start_time = time.time()
+
+        workbook = load_workbook(self.excel_path)
+        for row in self.rows:
+            sheet = workbook[row['sheet']]
+            line = sheet.max_row + 1
+            for column, value in row['values'].items():
+                sheet[f"{column}{line}"] = value
+
+        # Le classeur est remplacé d'un coup, une interruption ne le laisse pas à moitié écrit.
+        temp_path = f"{self.excel_path}.tmp"
+        workbook.save(temp_path)
+        # The journal is only emptied once the rows are on disk in the workbook.
+        with open(temp_path, 'rb') as saved:
+            os.fsync(saved.fileno())
+        os.replace(temp_path, self.excel_path)
+        self._journal.truncate(0)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+        print(f"==> {len(self.rows)} rows written to {self.excel_path}. Time taken: {time.time() - start_time:.2f} seconds.")
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self._journal.close()
+        os.remove(self.journal_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Even on error, the rows of the SPIs already processed are written.
+        self.close()
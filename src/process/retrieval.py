@@ -0,0 +1,131 @@
+# build_retrieval_index
+# save_retrieval_index
+# load_retrieval_index
+# shortlist_forms
+
+import os
+import time
+import numpy as np
+import cv2
+
+RETRIEVAL_INDEX_FILE = 'retrieval_index.npz'
+
+def build_vocabulary(descriptors, nb_words=512, attempts=3):
+    """
+    Cluster descriptors into a visual vocabulary with k-means.
+
+    :param descriptors: N x 256 float32 descriptors.
+    :param nb_words: Number of visual words.
+    :return: nb_words x 256 float32 matrix of unit normalized visual words.
+    """
+    nb_words = min(nb_words, descriptors.shape[0])
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 1e-4)
+    _, _, centers = cv2.kmeans(np.float32(descriptors), nb_words, None, criteria, attempts, cv2.KMEANS_PP_CENTERS)
+    centers /= np.maximum(np.linalg.norm(centers, axis=1), 1e-12)[:, np.newaxis]
+    return np.ascontiguousarray(centers, dtype=np.float32)
+
+def quantize(descriptors, vocabulary, chunk_size=4096):
+    """
+    Assign each descriptor to its nearest visual word.
+
+    :param descriptors: N x 256 float32 unit normalized descriptors.
+    :return: N array of visual word ids.
+    """
+    words = np.empty(descriptors.shape[0], dtype=np.int64)
+    for start in range(0, descriptors.shape[0], chunk_size):
+        # For unit vectors the nearest word is the one with the largest dot product.
+        words[start:start + chunk_size] = np.argmax(descriptors[start:start + chunk_size] @ vocabulary.T, axis=1)
+    return words
+
+def build_retrieval_index(trained_models, nb_words=512):
+    """
+    Build a visual vocabulary over the reference descriptors and an inverted index
+    from each visual word to the forms it appears in, weighted with TF-IDF.
+
+    :param trained_models: dict
+        Form name -> {'desc': 256xN descriptors, 'kp': keypoints}, as returned by load_models.
+    :return: dict
+        'names', 'vocabulary', 'idf' and the inverted index in CSR layout: the forms of
+        word w are 'postings_forms'[ptr[w]:ptr[w+1]], with weights 'postings_weights'.
+    """
+    print("==> Building retrieval index...")
+    start_time = time.time()
+
+    names = list(trained_models.keys())
+    desc = [np.float32(trained_models[name]['desc']).T for name in names]
+    vocabulary = build_vocabulary(np.concatenate(desc, axis=0), nb_words)
+    nb_words = vocabulary.shape[0]
+
+    # Term frequencies, one row per form.
+    tf = np.zeros((len(names), nb_words), dtype=np.float32)
+    for i, form_desc in enumerate(desc):
+        counts = np.bincount(quantize(form_desc, vocabulary), minlength=nb_words)
+        tf[i] = counts / max(counts.sum(), 1)
+
+    doc_freq = np.count_nonzero(tf, axis=0)
+    idf = np.float32(np.log(len(names) / np.maximum(doc_freq, 1)))
+    weights = tf * idf
+    weights /= np.maximum(np.linalg.norm(weights, axis=1), 1e-12)[:, np.newaxis]
+
+    # Inverted index: keep only the non zero entries, grouped by word.
+    words, forms = np.nonzero(weights.T)
+    ptr = np.zeros(nb_words + 1, dtype=np.int64)
+    ptr[1:] = np.cumsum(np.bincount(words, minlength=nb_words))
+
+    print(f"==> Retrieval index built. Time taken: {time.time() - start_time:.2f} seconds.")
+    return {
+        'names': np.array(names),
+        'vocabulary': vocabulary,
+        'idf': idf,
+        'postings_ptr': ptr,
+        'postings_forms': forms.astype(np.int64),
+        'postings_weights': weights[forms, words],
+    }
+
+def save_retrieval_index(index, folder_path):
+    """Save the retrieval index next to the form folders."""
+    np.savez(os.path.join(folder_path, RETRIEVAL_INDEX_FILE), **index)
+
+def load_retrieval_index(folder_path):
+    """Load the retrieval index of a reference folder, None if it was not built."""
+    index_path = os.path.join(folder_path, RETRIEVAL_INDEX_FILE)
+    if not os.path.exists(index_path):
+        return None
+
+    with np.load(index_path) as data:
+        index = {key: data[key] for key in data.files}
+    index['names'] = [str(name) for name in index['names']]
+    return index
+
+def shortlist_forms(descriptors, index, top_k=8):
+    """
+    Score every indexed form against a page with the inverted index and keep the best ones.
+
+    :param descriptors: 256xN descriptors of the page.
+    :param index: dict returned by build_retrieval_index or load_retrieval_index.
+    :param top_k: Size of the shortlist.
+    :return: list
+        Names of the top_k forms, best first.
+    """
+    vocabulary = index['vocabulary']
+    nb_words = vocabulary.shape[0]
+    words = quantize(np.ascontiguousarray(np.float32(descriptors).T), vocabulary)
+
+    counts = np.bincount(words, minlength=nb_words)
+    query_words = np.nonzero(counts)[0]
+    query_weights = counts[query_words] / counts.sum() * index['idf'][query_words]
+    query_weights /= max(np.linalg.norm(query_weights), 1e-12)
+
+    # Walk only the postings of the words present in the page.
+    ptr = index['postings_ptr']
+    lengths = ptr[query_words + 1] - ptr[query_words]
+    starts = np.repeat(ptr[query_words], lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    postings = starts + offsets
+
+    scores = np.bincount(index['postings_forms'][postings],
+                         weights=index['postings_weights'][postings] * np.repeat(query_weights, lengths),
+                         minlength=len(index['names']))
+
+    best = np.argsort(-scores, kind='stable')[:top_k]
+    return [index['names'][i] for i in best]
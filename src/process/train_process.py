@@ -1,8 +1,9 @@
 # check_pkl_files
 # process_train
 # keep_common_inliers
-# save_descriptors
 # load_models
+# load_pkl_models
+# train_retrieval_index
 
 import os
 import time
@@ -12,6 +13,8 @@ import cv2
 import pickle
 from src.superpoint.superpoint import initialize_superpoint
 from src.process.process import process_form_folder
+from src.process.retrieval import build_retrieval_index, save_retrieval_index, RETRIEVAL_INDEX_FILE
+from src.process.model_store import save_model_store, open_model_store, check_model_store
 
 def check_pkl_files(folder_path):
     """
@@ -48,16 +51,24 @@ def check_pkl_files(folder_path):
     
 def process_train(folder_path, force):
     
-    if not force and check_pkl_files(folder_path) == True:
-            print(f"No processing is required on the directory: {folder_path}, as it already contains at least two '.pkl' files in each sub-folder.")
+    if not force and check_model_store(folder_path):
+            print(f"No processing is required on the directory: {folder_path}, as it already contains a model store for each sub-folder.")
+            if not os.path.exists(os.path.join(folder_path, RETRIEVAL_INDEX_FILE)):
+                train_retrieval_index(folder_path)
+    elif not force and check_pkl_files(folder_path) == True:
+            # Descriptors computed by a previous version, only the storage format changes.
+            print(f"Converting the '.pkl' files of the directory: {folder_path} to a model store.")
+            save_model_store(load_pkl_models(folder_path), folder_path)
+            train_retrieval_index(folder_path)
     else:
         superpoint = initialize_superpoint()
 
         # For training
         print("==> Starting training phase...")
         start_time = time.time()
+        trained_models = {}
         
-        for form_folder in os.listdir(folder_path):
+        for form_folder in sorted(os.listdir(folder_path)):
             form_folder_path = os.path.join(folder_path, form_folder)
         
             if os.path.isdir(form_folder_path):        
@@ -67,11 +78,20 @@ def process_train(folder_path, force):
                 new_desc, new_kp = keep_common_inliers(desc_ref, descriptors_list, kp_ref, keypoints_list)
                 print(new_desc.shape)
                 print(new_kp.shape)
-                ## Save descriptors
-                save_descriptors(new_desc, new_kp, form_folder, form_folder_path)
-                print('save')
+                trained_models[form_folder] = {'desc': new_desc, 'kp': new_kp}
+
+        ## Save descriptors
+        save_model_store(trained_models, folder_path)
+        print('save')
+
+        train_retrieval_index(folder_path)
         print(f"==> Training phase completed. Total time taken: {time.time() - start_time:.2f} seconds.")
 
+def train_retrieval_index(folder_path):
+    """Build the visual-word inverted index used to shortlist the reference forms."""
+    index = build_retrieval_index(load_models(folder_path))
+    save_retrieval_index(index, folder_path)
+
 
 def keep_common_inliers(ref_desc, desc_list, kp_ref, kp_list):
     # Initialise un histogramme pour compter les inliers pour chaque descripteur de référence
@@ -116,51 +136,45 @@ def keep_common_inliers(ref_desc, desc_list, kp_ref, kp_list):
     # Retourne les descripteurs et keypoints sélectionnés
     return np.array(top_1000_desc).T, np.array(top_1000_kp).T
 
-def save_descriptors(descriptors, keypoints_list, form_name, form_folder_path):
-    """Save descriptors to a file."""
-
-    print(f"==> Saving descriptors for form: {form_name}...")
-    start_time = time.time()
-
-    # Create directory if it doesn't exist
-    if not os.path.exists(form_folder_path):
-        os.makedirs(form_folder_path)
-        
-    # Save Descriptors
-    descriptor_file_path = os.path.join(form_folder_path, f"{form_name}_descriptors.pkl")
-    with open(descriptor_file_path, 'wb') as f:
-        pickle.dump(descriptors, f)
-        
-    # Save Keypoints
-    descriptor_file_path = os.path.join(form_folder_path, f"{form_name}_keypoints.pkl")
-    with open(descriptor_file_path, 'wb') as f:
-        pickle.dump(keypoints_list, f)
-
-    print(f"==> Descriptors and Keypoints saved. Time taken: {time.time() - start_time:.2f} seconds.")
-
 def load_models(folder_path):
+    """
+    Load the reference models of every form. The model store is memory-mapped and
+    each form is only read when used; the legacy '.pkl' files are read otherwise.
+    """
     print("==> Loading descriptors...")
     start_time = time.time()
+
+    trained_models = open_model_store(folder_path)
+    if trained_models is None:
+        print(f"No model store in {folder_path}, loading '.pkl' files. Run the preprocess to convert them.")
+        trained_models = load_pkl_models(folder_path)
+            
+    print(f"==> Descriptors loaded. Time taken: {time.time() - start_time:.2f} seconds.")
+    
+    return trained_models
+
+def load_pkl_models(folder_path):
     trained_models = {}
     
-    for form_folder in os.listdir(folder_path):
-        descriptor_model_path = os.path.join(folder_path, form_folder, f"{form_folder}_descriptors.pkl")
-        
-        if os.path.exists(descriptor_model_path):
-            # Load Descriptors
-            with open(descriptor_model_path, 'rb') as f:
-                descriptors = pickle.load(f)
+    for form_folder in sorted(os.listdir(folder_path)):
+        if not os.path.isdir(os.path.join(folder_path, form_folder)):
+            continue
 
+        descriptor_model_path = os.path.join(folder_path, form_folder, f"{form_folder}_descriptors.pkl")
         keypoints_model_path = os.path.join(folder_path, form_folder, f"{form_folder}_keypoints.pkl")
-        
-        if os.path.exists(keypoints_model_path):
-            # Load Descriptors
-            with open(keypoints_model_path, 'rb') as f:
-                keypoints = pickle.load(f)
 
+        if not os.path.exists(descriptor_model_path) or not os.path.exists(keypoints_model_path):
+            print(f"Warning: missing '.pkl' files for form {form_folder}, form skipped.")
+            continue
+
+        # Load Descriptors
+        with open(descriptor_model_path, 'rb') as f:
+            descriptors = pickle.load(f)
+
+        # Load Keypoints
+        with open(keypoints_model_path, 'rb') as f:
+            keypoints = pickle.load(f)
 
         trained_models[form_folder] = {'desc': descriptors, 'kp': keypoints}
-            
-    print(f"==> Descriptors loaded. Time taken: {time.time() - start_time:.2f} seconds.")
     
-    return trained_models
\ No newline at end of file
+    return trained_models
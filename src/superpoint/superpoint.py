@@ -82,9 +82,11 @@ class SuperPointNet(torch.nn.Module):
 class SuperPointFrontend(object):
     """ Wrapper around pytorch net to help with pre and post image processing. """
     def __init__(self, weights_path, nms_dist, conf_thresh, nn_thresh,
-               cuda=False):
+               cuda=False, nms_mode='fast'):
+        assert nms_mode in ('fast', 'maxpool'), 'Unknown NMS mode.'
         self.name = 'SuperPoint'
         self.cuda = cuda
+        self.nms_mode = nms_mode
         self.nms_dist = nms_dist
         self.conf_thresh = conf_thresh
         self.nn_thresh = nn_thresh # L2 descriptor distance for good match.
@@ -103,7 +105,8 @@ class SuperPointFrontend(object):
                                map_location=lambda storage, loc: storage))
         self.net.eval()
 
-    def nms_fast(self, in_corners, H, W, dist_thresh):
+    @staticmethod
+    def nms_fast(in_corners, H, W, dist_thresh):
         """
         Run a faster approximate Non-Max-Suppression on numpy corners shaped:
           3xN [x_i,y_i,conf_i]^T
@@ -168,6 +171,45 @@ class SuperPointFrontend(object):
         out_inds = inds1[inds_keep[inds2]]
         return out, out_inds
 
+    @staticmethod
+    def nms_maxpool(heatmap, conf_thresh, dist_thresh):
+        """
+        Vectorised Non-Max-Suppression on a full resolution heatmap, giving the
+        same corners as nms_fast (up to points with exactly equal confidence).
+
+        Algo summary: every candidate (confidence >= conf_thresh) that is the
+        maximum of its (2*dist_thresh+1)^2 window is kept. The neighbourhood of
+        the kept points is then suppressed and the local maxima of the remaining
+        candidates are kept, until no candidate is left. Each step is a stride 1
+        max-pool (grayscale dilation) over the whole heatmap, so there is no
+        Python loop over corners.
+
+        Inputs
+          heatmap - HxW numpy heatmap in range [0,1] of point confidences.
+          conf_thresh - Minimum confidence of a corner.
+          dist_thresh - Distance to suppress, measured as an infinty norm distance.
+        Returns
+          nmsed_corners - 3xN numpy array with surviving corners [x_i, y_i, confidence_i]^T.
+        """
+        kernel = np.ones((2*dist_thresh+1, 2*dist_thresh+1), np.uint8)
+        heatmap = np.float32(heatmap)
+        # Heatmap values are in [0,1], -1 marks points that can not be kept.
+        alive = np.where(heatmap >= conf_thresh, heatmap, np.float32(-1))
+        keep = (alive >= 0) & (alive == cv2.dilate(alive, kernel))
+        while True:
+            suppressed = cv2.dilate(keep.astype(np.uint8), kernel) > 0
+            alive[suppressed] = -1
+            new_keep = (alive >= 0) & (alive == cv2.dilate(alive, kernel))
+            if not new_keep.any():
+                break
+            keep |= new_keep
+        ys, xs = np.nonzero(keep)
+        pts = np.zeros((3, len(xs))) # Populate point data sized 3xN.
+        pts[0, :] = xs
+        pts[1, :] = ys
+        pts[2, :] = heatmap[ys, xs]
+        return pts
+
     def run(self, img):
         """ Process a numpy image to extract points and descriptors.
         Input
@@ -183,14 +225,55 @@ class SuperPointFrontend(object):
         inp = img.copy()
         inp = (inp.reshape(1, H, W))
         inp = torch.from_numpy(inp)
-        inp = torch.autograd.Variable(inp).view(1, 1, H, W)
+        inp = inp.view(1, 1, H, W)
         if self.cuda:
             inp = inp.cuda()
         # Forward pass of network.
-        outs = self.net.forward(inp)
+        with torch.no_grad():
+            outs = self.net.forward(inp)
         semi, coarse_desc = outs[0], outs[1]
         # Convert pytorch -> numpy.
         semi = semi.data.cpu().numpy().squeeze()
+        return self.postprocess(semi, coarse_desc, H, W)
+
+    def run_batch(self, imgs):
+        """ Process several numpy images of the same size with a single forward
+        pass of the network.
+        Input
+          imgs - list of HxW numpy float32 input images in range [0,1].
+        Output
+          list of (corners, desc, heatmap) tuples, one per image, as returned
+          by run.
+          """
+        assert len(imgs) > 0, 'At least one image is required.'
+        H, W = imgs[0].shape[0], imgs[0].shape[1]
+        for img in imgs:
+            assert img.ndim == 2, 'Image must be grayscale.'
+            assert img.dtype == np.float32, 'Image must be float32.'
+            assert img.shape == (H, W), 'All images must have the same size.'
+        inp = torch.from_numpy(np.stack(imgs)).view(len(imgs), 1, H, W)
+        if self.cuda:
+            inp = inp.cuda()
+        # Single forward pass for the whole batch.
+        with torch.no_grad():
+            semi, coarse_desc = self.net.forward(inp)
+        semi = semi.data.cpu().numpy()
+        results = []
+        for i in range(len(imgs)):
+            results.append(self.postprocess(semi[i], coarse_desc[i:i+1], H, W))
+        return results
+
+    def postprocess(self, semi, coarse_desc, H, W):
+        """ Extract points and descriptors from the raw network outputs of one
+        image.
+        Input
+          semi - 65 x H/8 x W/8 numpy array of point logits.
+          coarse_desc - 1 x 256 x H/8 x W/8 pytorch tensor of descriptors.
+          H - Image height.
+          W - Image width.
+        Output
+          corners, desc, heatmap as returned by run.
+          """
         # --- Process points.
         dense = np.exp(semi) # Softmax.
         dense = dense / (np.sum(dense, axis=0)+.00001) # Should sum to 1.
@@ -203,14 +286,19 @@ class SuperPointFrontend(object):
         heatmap = np.reshape(nodust, [Hc, Wc, self.cell, self.cell])
         heatmap = np.transpose(heatmap, [0, 2, 1, 3])
         heatmap = np.reshape(heatmap, [Hc*self.cell, Wc*self.cell])
-        xs, ys = np.where(heatmap >= self.conf_thresh) # Confidence threshold.
-        if len(xs) == 0:
-            return np.zeros((3, 0)), None, None
-        pts = np.zeros((3, len(xs))) # Populate point data sized 3xN.
-        pts[0, :] = ys
-        pts[1, :] = xs
-        pts[2, :] = heatmap[xs, ys]
-        pts, _ = self.nms_fast(pts, H, W, dist_thresh=self.nms_dist) # Apply NMS.
+        if self.nms_mode == 'maxpool':
+            pts = self.nms_maxpool(heatmap, self.conf_thresh, self.nms_dist) # Apply NMS.
+            if pts.shape[1] == 0:
+                return np.zeros((3, 0)), None, None
+        else:
+            xs, ys = np.where(heatmap >= self.conf_thresh) # Confidence threshold.
+            if len(xs) == 0:
+                return np.zeros((3, 0)), None, None
+            pts = np.zeros((3, len(xs))) # Populate point data sized 3xN.
+            pts[0, :] = ys
+            pts[1, :] = xs
+            pts[2, :] = heatmap[xs, ys]
+            pts, _ = self.nms_fast(pts, H, W, dist_thresh=self.nms_dist) # Apply NMS.
         inds = np.argsort(pts[2,:])
         pts = pts[:,inds[::-1]] # Sort by confidence.
         # Remove points along border.
@@ -238,7 +326,7 @@ class SuperPointFrontend(object):
             desc /= np.linalg.norm(desc, axis=0)[np.newaxis, :]
         return pts, desc, heatmap
     
-def initialize_superpoint():
+def initialize_superpoint(nms_mode='maxpool'):
     """Initialize SuperPoint model."""
     print('==> Initializing SuperPoint...')
     start_time = time.time()
@@ -246,6 +334,7 @@ def initialize_superpoint():
                                     nms_dist=4,
                                     conf_thresh=0.015,
                                     nn_thresh=0.7,
-                                    cuda=False)
+                                    cuda=False,
+                                    nms_mode=nms_mode)
     print(f"==> SuperPoint initialized. Time taken: {time.time() - start_time:.2f} seconds.")
     return superpoint
\ No newline at end of file
@@ -2,6 +2,7 @@ import streamlit as st
 from src.process.train_process import process_train
 from form_recognizer import process_inference_file, process_inference_excel
 from src.benchmark.benchmarking import run_bench
+from src.process.inference_process import InferenceSession
 import tempfile
 import os
 import threading
@@ -50,6 +51,11 @@ def interface():
     if st.button("Exécuter Inférence (Excel)"):
         execute_inference_excel(inference_excel_path, nb_files_excel, nb_ocr_excel, ocr, benchmark_excel)
 
+@st.cache_resource
+def load_session():
+    # Loaded once per Streamlit server, shared by every rerun of the script.
+    return InferenceSession('./data/forms_ref')
+
 def run_dash_server():
     os.system('python src/benchmark/dash_benchmarks.py')
 
@@ -61,19 +67,19 @@ def execute_preprocess(path, force=False):
     if force:
         st.write("Option --force activée")
     process_train(path, force)
+    # The reference models may have changed on disk.
+    load_session.clear()
 
 def execute_inference_excel(path_excel, nb_files, nb_ocr, ocr, benchmark=False):
     if benchmark:
         st.write("Benchmark activé")
-    df = process_inference_excel(path_excel, ocr, nb_files, nb_ocr)
+    df = process_inference_excel(path_excel, ocr, nb_files, nb_ocr, session=load_session())
     print(df)
     st.dataframe(df)
 
+    # Le fichier xlsx est lu directement, sans conversion en ods.
     acquisition_path = './data/excel/Acquisition.xlsx'
-    acquisition_ods_path = './data/excel/Acquisition.ods'
-    os.system(f'libreoffice --headless --convert-to ods {acquisition_path} --outdir ./data/excel')
-
-    run_bench('./data/excel/verite_terrain.ods', './data/excel/Acquisition.ods')
+    run_bench('./data/excel/verite_terrain.ods', acquisition_path)
     run_dash_server()
 
 def execute_inference_file(uploaded_file, nb_ocr, ocr, benchmark=False):
@@ -88,7 +94,7 @@ def execute_inference_file(uploaded_file, nb_ocr, ocr, benchmark=False):
             if benchmark:
                 st.write("Benchmark activé")
 
-            df = process_inference_file(temp_file_path, nb_ocr, ocr)
+            df = process_inference_file(temp_file_path, nb_ocr, ocr, session=load_session())
             st.dataframe(df)
     else:
         st.error("Aucun fichier fourni.")